@@ -0,0 +1,392 @@
+"""
+Scaling benchmark for the health checks against a synthetic cluster.
+
+Starts a local fake apiserver serving a generated cluster of the requested
+size (nodes, pods, Velero backups and metrics.k8s.io usage), points the real
+kubernetes client at it through a generated kubeconfig, and runs each check,
+and the PDF report, in a fresh interpreter. Wall time, peak RSS and the
+number of API calls served are reported per cluster size and check, and
+compared with a previous run when --baseline is given.
+
+Usage:
+    python benchmarks/cluster_benchmark.py [--sizes 10:100:100,500:10000:1000]
+        [--checks nodes,node_versions,pods,backup,resource_usage,pdf]
+        [--output results.json] [--baseline results.json] [--tolerance 0.25]
+
+A size is NODES:PODS:BACKUPS.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = "10:100:100,500:10000:1000,5000:100000:5000"
+DEFAULT_CHECKS = "nodes,node_versions,pods,backup,resource_usage,pdf"
+# Shape of the synthetic cluster, relative to its size
+PODS_PER_WORKLOAD = 50
+NAMESPACES = 100
+SCHEDULES = 20
+BASE_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class SyntheticCluster:
+    """Generate the objects of a cluster of a given size from their index."""
+
+    def __init__(self, nodes, pods, backups):
+        self.nodes = nodes
+        self.pods = pods
+        self.backups = backups
+        self.namespaces = max(1, min(NAMESPACES, pods))
+
+    def node_name(self, i):
+        return f"ip-10-{i // 65536}-{i // 256 % 256}-{i % 256}.ec2.internal"
+
+    def node(self, i):
+        return {
+            "metadata": {
+                "name": self.node_name(i),
+                "labels": {
+                    "eks.amazonaws.com/nodegroup": f"ng-{i % 4}",
+                    "node.kubernetes.io/instance-type": ("m5.xlarge", "c5.2xlarge")[i % 2],
+                },
+            },
+            "status": {
+                "conditions": [{"type": "Ready", "status": "False" if i % 97 == 96 else "True"}],
+                "nodeInfo": {"kubeletVersion": f"v1.{28 + i % 2}.{i % 5}-eks-5e0fdde"},
+                "allocatable": {"cpu": "3920m", "memory": "15076868Ki", "pods": "58"},
+            },
+        }
+
+    def namespace(self, i):
+        return f"ns-{i % self.namespaces}"
+
+    def pod(self, i):
+        workload = f"app-{i // PODS_PER_WORKLOAD}"
+        crashing = i % 211 == 210
+        return {
+            "metadata": {
+                "namespace": self.namespace(i),
+                "name": f"{workload}-7c9f8d6b5-{i:06x}",
+                "labels": {"app": workload, "pod-template-hash": "7c9f8d6b5"},
+                "ownerReferences": [
+                    {"kind": "ReplicaSet", "name": f"{workload}-7c9f8d6b5", "controller": True}
+                ],
+            },
+            "spec": {
+                "nodeName": self.node_name(i % max(self.nodes, 1)),
+                "containers": [
+                    {"name": "app", "resources": {"requests": {"cpu": "100m", "memory": "128Mi"}}},
+                    {"name": "sidecar", "resources": {"requests": {"cpu": "10m", "memory": "32Mi"}}},
+                ],
+            },
+            "status": {
+                "phase": "Pending" if i % 499 == 498 else "Running",
+                "containerStatuses": [
+                    {
+                        "name": "app",
+                        "ready": not crashing,
+                        "restartCount": 14 if crashing else 0,
+                        "state": {"waiting": {"reason": "CrashLoopBackOff"}}
+                        if crashing
+                        else {"running": {}},
+                    },
+                    {"name": "sidecar", "ready": True, "restartCount": 0, "state": {"running": {}}},
+                ],
+            },
+        }
+
+    def backup(self, i):
+        schedule = f"schedule-{i % SCHEDULES}"
+        created = BASE_TIME + timedelta(hours=i)
+        return {
+            "metadata": {
+                "name": f"{schedule}-{created:%Y%m%d%H%M%S}",
+                "creationTimestamp": created.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "labels": {"velero.io/schedule-name": schedule},
+            },
+            "status": {"phase": "PartiallyFailed" if i % 13 == 12 else "Completed"},
+        }
+
+    def node_metrics(self, i):
+        return {
+            "metadata": {"name": self.node_name(i)},
+            "usage": {"cpu": f"{500 + i % 3400}m", "memory": f"{4000000 + i % 11000000}Ki"},
+        }
+
+    def pod_metrics(self, i):
+        pod = self.pod(i)["metadata"]
+        return {
+            "metadata": {"namespace": pod["namespace"], "name": pod["name"]},
+            "containers": [
+                {"name": "app", "usage": {"cpu": f"{i % 200}m", "memory": f"{100 + i % 60}Mi"}},
+                {"name": "sidecar", "usage": {"cpu": "2m", "memory": "20Mi"}},
+            ],
+        }
+
+    def collection(self, path, query):
+        """
+        Return (indices, make_item, keep) for a LIST path, or None when unknown.
+        `indices` is a range of the object indices the path covers and `keep`
+        filters them further, e.g. by label selector.
+        """
+        match = re.fullmatch(r"/api/v1/namespaces/([^/]+)/pods", path)
+        if match:
+            namespace = match.group(1)
+            # Label shards of the sharded pod scan select on the "app" label
+            selector = query.get("labelSelector", [""])[0]
+            equal = re.fullmatch(r"app=(.+)", selector)
+            excluded = re.fullmatch(r"app notin \((.*)\)", selector)
+            return (
+                range(int(namespace[3:]), self.pods, self.namespaces)
+                if re.fullmatch(r"ns-\d+", namespace)
+                else range(0),
+                self.pod,
+                lambda i: (not equal or f"app-{i // PODS_PER_WORKLOAD}" == equal.group(1))
+                and (not excluded or f"app-{i // PODS_PER_WORKLOAD}" not in excluded.group(1).split(",")),
+            )
+        if path == "/api/v1/pods":
+            excluded = {
+                term.split("!=", 1)[1]
+                for term in query.get("fieldSelector", [""])[0].split(",")
+                if "metadata.namespace!=" in term
+            }
+            return range(self.pods), self.pod, lambda i: self.namespace(i) not in excluded
+        if path == "/api/v1/namespaces":
+            return (
+                range(self.namespaces),
+                lambda i: {"metadata": {"name": f"ns-{i}"}},
+                lambda i: True,
+            )
+        if path == "/api/v1/nodes":
+            return range(self.nodes), self.node, lambda i: True
+        if path == "/apis/velero.io/v1/backups":
+            selector = re.search(r" in \((.*)\)", query.get("labelSelector", [""])[0])
+            schedules = set(selector.group(1).split(",")) if selector else None
+            return (
+                range(self.backups),
+                self.backup,
+                lambda i: schedules is None or f"schedule-{i % SCHEDULES}" in schedules,
+            )
+        if path == "/apis/metrics.k8s.io/v1beta1/nodes":
+            return range(self.nodes), self.node_metrics, lambda i: True
+        if path == "/apis/metrics.k8s.io/v1beta1/pods":
+            return range(self.pods), self.pod_metrics, lambda i: True
+        return None
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """Serve paginated LIST calls of a `SyntheticCluster` and count them."""
+
+    protocol_version = "HTTP/1.1"
+    cluster = None
+    calls = None
+    lock = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        collection = self.cluster.collection(url.path, query)
+        if collection is None:
+            self.reply(404, {"kind": "Status", "status": "Failure", "reason": "NotFound"})
+            return
+        with self.lock:
+            self.calls[url.path] = self.calls.get(url.path, 0) + 1
+        indices, make_item, keep = collection
+        # The continue token is the position in `indices` to resume from
+        position = int(query.get("continue", ["0"])[0] or 0)
+        limit = int(query.get("limit", ["0"])[0] or 0) or len(indices)
+        items = []
+        while position < len(indices) and len(items) < limit:
+            if keep(indices[position]):
+                items.append(make_item(indices[position]))
+            position += 1
+        metadata = {"resourceVersion": "1"}
+        if position < len(indices):
+            metadata["continue"] = str(position)
+        self.reply(200, {"kind": "List", "apiVersion": "v1", "metadata": metadata, "items": items})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Function to start a fake apiserver for a synthetic cluster
+def start_fake_apiserver(cluster):
+    """
+    Serve `cluster` on a random local port from a background thread.
+    Returns:
+      The running server; its handler class holds the `calls` counters.
+    """
+    handler = type(
+        "BoundFakeApiHandler",
+        (FakeApiHandler,),
+        {"cluster": cluster, "calls": {}, "lock": threading.Lock()},
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-apiserver", daemon=True).start()
+    return server
+
+
+# Function to write a kubeconfig pointing at the fake apiserver
+def write_kubeconfig(directory, port):
+    path = os.path.join(directory, "kubeconfig")
+    kubeconfig = {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "clusters": [{"name": "fake", "cluster": {"server": f"http://127.0.0.1:{port}"}}],
+        "users": [{"name": "fake", "user": {"token": "benchmark"}}],
+        "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake"}}],
+        "current-context": "fake",
+    }
+    with open(path, "w") as f:
+        json.dump(kubeconfig, f)
+    return path
+
+
+# Function to measure one check, or the PDF report, inside the worker process
+def run_worker(target, directory):
+    import resource
+
+    sys.path.insert(0, REPO_ROOT)
+    import healthcheck as hc
+
+    started = time.perf_counter()
+    if target == "pdf":
+        # The report is measured on its own, after the checks it is built from
+        results = hc.run_quietly(hc.run_checks, hc.CHECKS)
+        started = time.perf_counter()
+        hc.run_quietly(
+            hc.write_pdf_report,
+            os.path.join(directory, "benchmark.pdf"),
+            "benchmark",
+            datetime.now(),
+            hc.check_sections(results),
+        )
+        status = "PASSED"
+    else:
+        results = hc.run_quietly(hc.run_checks, [hc.CHECK_REGISTRY[target]])
+        status = results[target][0]
+    wall_seconds = time.perf_counter() - started
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mib = peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    print(
+        json.dumps(
+            {"wall_seconds": round(wall_seconds, 4), "peak_rss_mib": round(peak_rss_mib, 1), "status": status}
+        )
+    )
+
+
+# Function to run one check in a fresh interpreter against the fake apiserver
+def measure(server, kubeconfig, target, directory):
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key not in ("KUBERNETES_SERVICE_HOST", "kube_contexts")
+    }
+    env.update(
+        KUBECONFIG=kubeconfig,
+        namespaces="*",
+        enabled_checks="nodes,node_versions,pods,backup" if target == "pdf" else target,
+        report_format="pdf",
+        snapshot_store="",
+        perf_report="false",
+    )
+    calls = server.RequestHandlerClass.calls
+    with server.RequestHandlerClass.lock:
+        calls.clear()
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", target, "--directory", directory],
+        cwd=directory,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    with server.RequestHandlerClass.lock:
+        result["api_calls"] = sum(calls.values())
+    return result
+
+
+# Function to list the measurements that regressed against a baseline
+def regressions(results, baseline, tolerance):
+    previous = {(result["size"], result["check"]): result for result in baseline}
+    found = []
+    for result in results:
+        before = previous.get((result["size"], result["check"]))
+        if before is None:
+            continue
+        for metric in ("wall_seconds", "peak_rss_mib"):
+            if result[metric] > before[metric] * (1 + tolerance):
+                found.append(f"{result['size']} {result['check']}: {metric} {before[metric]} -> {result[metric]}")
+        if result["api_calls"] > before["api_calls"]:
+            found.append(
+                f"{result['size']} {result['check']}: api_calls {before['api_calls']} -> {result['api_calls']}"
+            )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES)
+    parser.add_argument("--checks", default=DEFAULT_CHECKS)
+    parser.add_argument("--output", help="Write the measurements to this JSON file")
+    parser.add_argument("--baseline", help="Fail when a measurement regresses against this file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--directory", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.directory)
+        return 0
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes.split(","):
+            nodes, pods, backups = (int(value) for value in size.split(":"))
+            server = start_fake_apiserver(SyntheticCluster(nodes, pods, backups))
+            try:
+                kubeconfig = write_kubeconfig(directory, server.server_address[1])
+                for target in args.checks.split(","):
+                    result = {"size": size, "check": target}
+                    result.update(measure(server, kubeconfig, target, directory))
+                    print(json.dumps(result), flush=True)
+                    results.append(result)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
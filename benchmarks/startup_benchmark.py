@@ -0,0 +1,86 @@
+"""
+Startup-time benchmark for healthcheck.py.
+
+Imports the module in fresh interpreters, reports the median import time and
+fails when it exceeds a budget or when a heavy dependency (kubernetes,
+reportlab, boto3, numpy, the email stack) is loaded at import time.
+
+Usage:
+    python benchmarks/startup_benchmark.py [--runs 10] [--max-seconds 0.25]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules that must only be imported by the stage that needs them
+LAZY_MODULES = [
+    "kubernetes",
+    "reportlab",
+    "boto3",
+    "numpy",
+    "smtplib",
+    "email.mime.multipart",
+]
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import healthcheck
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+
+def measure_import(runs):
+    """Import healthcheck in `runs` fresh interpreters and return the probe results."""
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE],
+            cwd=REPO_ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-seconds", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = measure_import(args.runs)
+    timings = [result["seconds"] for result in results]
+    loaded = sorted({module for result in results for module in result["loaded"]})
+    median = statistics.median(timings)
+    print(
+        json.dumps(
+            {
+                "runs": args.runs,
+                "median_seconds": round(median, 4),
+                "min_seconds": round(min(timings), 4),
+                "max_seconds": round(max(timings), 4),
+                "eagerly_loaded": loaded,
+            }
+        )
+    )
+    if loaded:
+        print(f"Heavy modules imported at startup: {', '.join(loaded)}", file=sys.stderr)
+        return 1
+    if median > args.max_seconds:
+        print(
+            f"Median import time {median:.3f}s exceeds the {args.max_seconds:.3f}s budget",
+            file=sys.stderr,
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
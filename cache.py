@@ -0,0 +1,258 @@
+import glob
+import json
+import os
+import threading
+import time
+from hashlib import blake2b
+from healthcheck import (
+    call_api,
+    print_color,
+    resource_cache_directory,
+    resource_cache_ttl,
+    resource_cache_watch_seconds,
+    _count_perf,
+    NC,
+    RED,
+)
+
+# Version of the cache file layout, files of another version are ignored
+CACHE_FORMAT = 1
+# Asks the apiserver for names and resourceVersions only, not the full objects
+METADATA_ACCEPT = "application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,application/json"
+# LIST arguments of the kubernetes client that are query parameters of a raw request
+QUERY_PARAMETERS = {"label_selector": "labelSelector", "field_selector": "fieldSelector"}
+
+
+# Function to name the cache file of an informer
+def cache_path(informer, directory=None):
+    """
+    Key the cache by apiserver, resource and LIST arguments, so clusters and
+    selectors never share a file.
+    """
+    api_client = informer.list_func.__self__.api_client
+    key = json.dumps(
+        [api_client.configuration.host, informer.name, informer.list_kwargs],
+        sort_keys=True,
+        default=str,
+    )
+    digest = blake2b(key.encode(), digest_size=10).hexdigest()
+    return os.path.join(directory or resource_cache_directory, f"{informer.name}-{digest}.json")
+
+
+# Function to fill an informer from its cache file
+def load_cache(informer, record_type, directory=None):
+    """
+    Seed `informer` with the records, their resourceVersions and the list
+    resourceVersion saved by an earlier run.
+    Args:
+      informer: A `daemon.Informer`.
+      record_type: The record class the informer projects objects onto.
+      directory: The cache directory, defaults to resource_cache_directory.
+    Returns:
+      True if the informer was seeded, False when there is no usable cache:
+      none was saved, it is older than resource_cache_ttl days, or it was
+      written for other record fields.
+    """
+    path = cache_path(informer, directory)
+    try:
+        if time.time() - os.path.getmtime(path) > resource_cache_ttl * 86400:
+            return False
+        with open(path, encoding="utf-8") as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return False
+    if cached.get("format") != CACHE_FORMAT or cached.get("fields") != list(record_type.__slots__):
+        return False
+    informer.seed(
+        {key: record_type(*values) for key, (_, values) in cached["items"].items()},
+        {key: version for key, (version, _) in cached["items"].items()},
+        cached["resource_version"],
+    )
+    return True
+
+
+# Function to save the state of an informer to its cache file
+def save_cache(informer, record_type, directory=None):
+    with informer.lock:
+        items = {
+            key: [informer.versions.get(key), [getattr(record, field) for field in record_type.__slots__]]
+            for key, record in informer.store.items()
+        }
+        resource_version = informer.resource_version
+    path = cache_path(informer, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so an interrupted run keeps the old cache
+    with open(f"{path}.tmp", "w", encoding="utf-8") as cache_file:
+        json.dump(
+            {
+                "format": CACHE_FORMAT,
+                "fields": list(record_type.__slots__),
+                "resource_version": resource_version,
+                "items": items,
+            },
+            cache_file,
+            separators=(",", ":"),
+        )
+    os.replace(f"{path}.tmp", path)
+
+
+# Function to delete cache files no run has used for resource_cache_ttl days
+def evict_caches(directory=None):
+    cutoff = time.time() - resource_cache_ttl * 86400
+    for path in glob.glob(os.path.join(directory or resource_cache_directory, "*.json")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+# Function to GET a path of the apiserver and decode the JSON body
+def get_raw(api_client, path, accept="application/json", **query):
+    started = time.perf_counter()
+    response = call_api(
+        api_client.call_api,
+        path,
+        "GET",
+        query_params=[(key, value) for key, value in query.items() if value is not None],
+        header_params={"Accept": accept},
+        auth_settings=["BearerToken"],
+        _return_http_data_only=True,
+        _preload_content=False,
+    )
+    try:
+        data = response.data
+    finally:
+        response.release_conn()
+    _count_perf(api_calls=1, api_time=time.perf_counter() - started, bytes_received=len(data))
+    return json.loads(data)
+
+
+# Function to build the path of one object of a collection from its informer key
+def object_path(collection_path, key):
+    if "/" not in key:
+        return f"{collection_path}/{key}"
+    prefix, plural = collection_path.rsplit("/", 1)
+    namespace, name = key.split("/", 1)
+    return f"{prefix}/namespaces/{namespace}/{plural}/{name}"
+
+
+# Function to bring a seeded informer up to date from object metadata
+def sync_from_metadata(informer, collection_path):
+    """
+    List only the names and resourceVersions of the collection, fetch the
+    objects whose resourceVersion differs from the cached one, and drop the
+    cached objects that are gone. When more than half of the objects changed,
+    one full LIST is cheaper than a GET per object, so the informer re-lists.
+    Args:
+      informer: A seeded `daemon.Informer`.
+      collection_path: The API path of the collection, e.g. "/api/v1/nodes".
+    Returns:
+      "metadata", or "list" when the informer re-listed.
+    """
+    from kubernetes.client.rest import ApiException
+
+    api_client = informer.list_func.__self__.api_client
+    query = {
+        QUERY_PARAMETERS[name]: value
+        for name, value in informer.list_kwargs.items()
+        if name in QUERY_PARAMETERS
+    }
+    current = {}
+    _continue = None
+    while True:
+        page = get_raw(
+            api_client,
+            collection_path,
+            METADATA_ACCEPT,
+            limit=informer.page_size,
+            **{"continue": _continue},
+            **query,
+        )
+        for item in page.get("items") or []:
+            current[informer.key(item)] = item["metadata"].get("resourceVersion")
+        metadata = page.get("metadata", {})
+        _continue = metadata.get("continue")
+        if not _continue:
+            break
+    with informer.lock:
+        changed = [key for key, version in current.items() if informer.versions.get(key) != version]
+        removed = [key for key in informer.store if key not in current]
+    if len(changed) > len(current) / 2:
+        informer.relist()
+        return "list"
+    for key in changed:
+        try:
+            informer.apply("MODIFIED", get_raw(api_client, object_path(collection_path, key)))
+        except ApiException as e:
+            # Deleted since the metadata LIST
+            if e.status != 404:
+                raise
+            removed.append(key)
+    for key in removed:
+        namespace, _, name = key.rpartition("/")
+        informer.apply("DELETED", {"metadata": {"name": name, "namespace": namespace or None}})
+    informer.resource_version = metadata.get("resourceVersion")
+    return "metadata"
+
+
+# Function to bring a seeded informer up to date
+def catch_up(informer, collection_path, watch_seconds=None):
+    """
+    Replay the changes since the cached resourceVersion with one short WATCH.
+    The apiserver only keeps a few minutes of history, so after a longer gap
+    it answers 410 Gone and the informer is synced from object metadata
+    instead.
+    Returns:
+      "watch", "metadata" or "list", depending on how the informer was brought up to date.
+    """
+    from kubernetes.client.rest import ApiException
+    from daemon import ResourceVersionExpired
+
+    seconds = resource_cache_watch_seconds if watch_seconds is None else watch_seconds
+    if seconds > 0:
+        try:
+            informer.watch(threading.Event(), timeout=seconds)
+            return "watch"
+        except ResourceVersionExpired:
+            pass
+        except ApiException as e:
+            if e.status != 410:
+                raise
+    return sync_from_metadata(informer, collection_path)
+
+
+# Function to list a resource through its on-disk cache
+def cached_records(name, list_func, project, record_type, collection_path, page_size=None, **list_kwargs):
+    """
+    Return the records of a resource, downloading only what changed since
+    the cache was saved. Without a usable cache the resource is listed in
+    full. The cache is saved again afterwards, and cache files unused for
+    resource_cache_ttl days are deleted.
+    Args:
+      name: Name of the resource, e.g. "nodes".
+      list_func: A bound kubernetes client LIST method that also supports watch=True.
+      project: The function turning a raw object into a record.
+      record_type: The record class `project` returns.
+      collection_path: The API path of the collection, e.g. "/api/v1/nodes".
+      page_size: The number of items requested per LIST call.
+      **list_kwargs: Extra arguments for `list_func`, e.g. selectors.
+    Returns:
+      A list of records.
+    """
+    from daemon import Informer
+
+    informer = Informer(name, list_func, project, page_size=page_size, **list_kwargs)
+    if load_cache(informer, record_type):
+        how = catch_up(informer, collection_path)
+        _count_perf(objects=len(informer.store))
+    else:
+        how = "list"
+        informer.relist()
+    try:
+        save_cache(informer, record_type)
+        evict_caches()
+    except OSError as e:
+        print_color(f"Error while saving the {name} cache: {str(e)}", RED)
+    print_color(f"{len(informer.store)} {name} loaded ({how})", NC)
+    return informer.records()
@@ -0,0 +1,501 @@
+import os
+import json
+import threading
+import time
+from datetime import datetime
+from kubernetes import client
+from kubernetes.watch.watch import iter_resp_lines
+import healthcheck as hc
+import cache
+from healthcheck import print_color, GREEN, RED, NC
+from metrics import Histogram, render_metrics, start_metrics_server
+
+# Seconds a single WATCH request stays open before it is renewed
+watch_timeout = int(os.environ.get("watch_timeout", 300))
+# Seconds between scheduled reports, 0 disables them
+report_interval = float(os.environ.get("report_interval", 86400))
+# Seconds between re-evaluations of the cached state for /metrics
+refresh_interval = float(os.environ.get("refresh_interval", 30))
+
+
+class ResourceVersionExpired(Exception):
+    """Raised when a WATCH resumes from a resourceVersion the apiserver has compacted."""
+
+
+class Informer:
+    """
+    Keep an in-memory cache of one resource type in sync with the apiserver.
+
+    The cache is filled by a paginated LIST and then kept current by a WATCH
+    resumed from the last seen resourceVersion. A full re-LIST only happens
+    when that resourceVersion has expired (HTTP 410 Gone).
+    Args:
+      name: A name for the informer, used in log messages and thread names.
+      list_func: A bound kubernetes client LIST method that also supports watch=True.
+      project: A function turning a raw object into a compact record, or
+        returning None for objects that should not be cached.
+      on_change: Called as on_change(informer, key, old, new) after each event.
+      on_resync: Called as on_resync(informer) after each full LIST.
+      page_size: The number of items requested per LIST call.
+      **list_kwargs: Extra arguments for `list_func`, e.g. namespace or selectors.
+    """
+
+    def __init__(
+        self,
+        name,
+        list_func,
+        project,
+        on_change=None,
+        on_resync=None,
+        page_size=None,
+        **list_kwargs,
+    ):
+        self.name = name
+        self.list_func = list_func
+        self.project = project
+        self.on_change = on_change
+        self.on_resync = on_resync
+        self.page_size = page_size
+        self.list_kwargs = list_kwargs
+        self.store = {}
+        # key -> resourceVersion of each cached object, to tell which ones changed
+        self.versions = {}
+        self.resource_version = None
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+
+    @staticmethod
+    def key(obj):
+        metadata = obj["metadata"]
+        namespace = metadata.get("namespace")
+        return f"{namespace}/{metadata['name']}" if namespace else metadata["name"]
+
+    def records(self):
+        """Return a snapshot of the cached records."""
+        with self.lock:
+            return list(self.store.values())
+
+    def seed(self, store, versions, resource_version):
+        """Fill the cache from records saved earlier, so the next WATCH resumes from them."""
+        with self.lock:
+            self.store = store
+            self.versions = versions
+            self.resource_version = resource_version
+        if self.on_resync:
+            self.on_resync(self)
+        self.synced.set()
+
+    def relist(self):
+        """Replace the cache with a fresh paginated LIST and remember its resourceVersion."""
+        store = {}
+        versions = {}
+        _continue = None
+        while True:
+            kwargs = dict(self.list_kwargs)
+            if self.page_size:
+                kwargs["limit"] = self.page_size
+            page = hc.list_raw(self.list_func, _continue=_continue, **kwargs)
+            for obj in page.get("items") or []:
+                record = self.project(obj)
+                if record is not None:
+                    store[self.key(obj)] = record
+                    versions[self.key(obj)] = obj["metadata"].get("resourceVersion")
+            metadata = page.get("metadata", {})
+            _continue = metadata.get("continue")
+            if not _continue:
+                break
+        with self.lock:
+            self.store = store
+            self.versions = versions
+            self.resource_version = metadata.get("resourceVersion")
+        if self.on_resync:
+            self.on_resync(self)
+        self.synced.set()
+
+    def apply(self, event_type, obj):
+        """Apply a single WATCH event to the cache."""
+        key = self.key(obj)
+        record = None if event_type == "DELETED" else self.project(obj)
+        with self.lock:
+            old = self.store.pop(key, None)
+            self.versions.pop(key, None)
+            if record is not None:
+                self.store[key] = record
+                self.versions[key] = obj["metadata"].get("resourceVersion")
+        if self.on_change and (old is not None or record is not None):
+            self.on_change(self, key, old, record)
+
+    def watch(self, stop, timeout=None):
+        """
+        Stream WATCH events from the last seen resourceVersion until the
+        request times out, after `timeout` seconds or watch_timeout.
+        """
+        timeout = timeout or watch_timeout
+        response = hc.call_api(
+            self.list_func,
+            watch=True,
+            resource_version=self.resource_version,
+            allow_watch_bookmarks=True,
+            timeout_seconds=timeout,
+            _preload_content=False,
+            _request_timeout=timeout + 30,
+            **self.list_kwargs,
+        )
+        try:
+            for line in iter_resp_lines(response):
+                if stop.is_set():
+                    return
+                event = json.loads(line)
+                obj = event["object"]
+                if event["type"] == "ERROR":
+                    if obj.get("code") == 410:
+                        raise ResourceVersionExpired(obj.get("message"))
+                    raise Exception(obj.get("message"))
+                self.resource_version = obj["metadata"]["resourceVersion"]
+                if event["type"] != "BOOKMARK":
+                    self.apply(event["type"], obj)
+        finally:
+            response.release_conn()
+
+    def run(self, stop):
+        """LIST once, then WATCH until `stop` is set, re-listing only after a 410."""
+        backoff = 1
+        while not stop.is_set():
+            try:
+                if self.resource_version is None:
+                    self.relist()
+                self.watch(stop)
+                backoff = 1
+            except ResourceVersionExpired:
+                self.resource_version = None
+            except client.ApiException as e:
+                if e.status == 410:
+                    self.resource_version = None
+                    continue
+                print_color(f"Error while watching {self.name}:", RED)
+                print_color(str(e), RED)
+                stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+            except Exception as e:
+                print_color(f"Error while watching {self.name}:", RED)
+                print_color(str(e), RED)
+                stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def start(self, stop):
+        threading.Thread(
+            target=self.run, args=(stop,), name=f"informer-{self.name}", daemon=True
+        ).start()
+
+
+class HealthState:
+    """
+    Health status maintained incrementally from informer events.
+
+    Every event only touches the failing-object set of the informer it came
+    from, so the summary is available at any time without walking the caches.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # informer name -> keys of cached objects that currently fail their check
+        self.failing = {}
+        # Velero schedule -> newest BackupRecord of that schedule
+        self.latest_backups = {}
+
+    @staticmethod
+    def is_failing(informer, record):
+        if isinstance(record, hc.NodeRecord):
+            return not record.ready and not record.name.startswith("fargate")
+        if isinstance(record, hc.PodRecord):
+            return hc.pod_problem(record) is not None
+        return False
+
+    def on_resync(self, informer):
+        with informer.lock:
+            items = list(informer.store.items())
+        failing = {key for key, record in items if self.is_failing(informer, record)}
+        with self.lock:
+            self.failing[informer.name] = failing
+            if informer.name == "backups":
+                self.latest_backups = {
+                    backup.schedule: backup
+                    for backup in hc.newest_backups_per_schedule(
+                        (record for _, record in items), 1
+                    )
+                }
+
+    def on_change(self, informer, key, old, new):
+        with self.lock:
+            failing = self.failing.setdefault(informer.name, set())
+            if new is not None and self.is_failing(informer, new):
+                failing.add(key)
+            else:
+                failing.discard(key)
+            if isinstance(new or old, hc.BackupRecord):
+                schedule = (new or old).schedule
+                current = self.latest_backups.get(schedule)
+                if new is not None and (
+                    current is None
+                    or new.creation_timestamp >= current.creation_timestamp
+                ):
+                    self.latest_backups[schedule] = new
+                elif new is None and current is not None and old.name == current.name:
+                    # The newest backup of the schedule was deleted, fall back to the next one
+                    remaining = hc.newest_backups_per_schedule(
+                        (
+                            record
+                            for record in informer.records()
+                            if record.schedule == schedule
+                        ),
+                        1,
+                    )
+                    if remaining:
+                        self.latest_backups[schedule] = remaining[0]
+                    else:
+                        del self.latest_backups[schedule]
+
+    def newest_backups(self):
+        """Return the newest backup of each schedule, ordered by schedule."""
+        with self.lock:
+            return [self.latest_backups[schedule] for schedule in sorted(self.latest_backups)]
+
+    def backups_failing(self):
+        """Whether there is no backup or the newest backup of any schedule is not completed."""
+        with self.lock:
+            return not self.latest_backups or any(
+                "Completed" not in backup.phase for backup in self.latest_backups.values()
+            )
+
+    def any_failing(self, names):
+        with self.lock:
+            return any(self.failing.get(name) for name in names)
+
+
+class HealthDaemon:
+    """
+    Long-running health checker serving results from LIST+WATCH caches.
+
+    Nodes, pods of the selected namespaces and Velero backups are cached by
+    informers. The pod namespace selection is resolved once at start-up.
+    """
+
+    def __init__(self):
+        self.stop = threading.Event()
+        self.state = HealthState()
+        api_client = hc.get_api_client()
+        core_api = client.CoreV1Api(api_client)
+        custom_api = client.CustomObjectsApi(api_client)
+        handlers = dict(on_change=self.state.on_change, on_resync=self.state.on_resync)
+
+        self.node_informer = Informer(
+            "nodes", core_api.list_node, hc.node_record, **handlers
+        )
+
+        namespaces = hc.select_namespaces(core_api)
+        if namespaces is not None and len(namespaces) <= hc.cluster_wide_threshold:
+            self.pod_informers = [
+                Informer(
+                    f"pods-{namespace}",
+                    core_api.list_namespaced_pod,
+                    hc.pod_record,
+                    page_size=hc.pod_page_size,
+                    namespace=namespace,
+                    **handlers,
+                )
+                for namespace in namespaces
+            ]
+        else:
+            wanted = set(namespaces) if namespaces is not None else None
+            field_selector = ",".join(
+                f"metadata.namespace!={namespace}" for namespace in hc.EXCLUDE_NAMESPACES
+            )
+            list_kwargs = {"field_selector": field_selector} if field_selector else {}
+            self.pod_informers = [
+                Informer(
+                    "pods",
+                    core_api.list_pod_for_all_namespaces,
+                    lambda pod: hc.pod_record(pod)
+                    if wanted is None or pod["metadata"]["namespace"] in wanted
+                    else None,
+                    page_size=hc.pod_page_size,
+                    **list_kwargs,
+                    **handlers,
+                )
+            ]
+
+        self.backup_informer = Informer(
+            "backups",
+            custom_api.list_cluster_custom_object,
+            hc.backup_record,
+            page_size=hc.velero_page_size,
+            group="velero.io",
+            version="v1",
+            plural="backups",
+            **({"label_selector": hc.velero_label_selector()} if hc.VELERO_SCHEDULES else {}),
+            **handlers,
+        )
+        self.informers = [self.node_informer, *self.pod_informers, self.backup_informer]
+        # Results of the last refresh, served by /metrics without touching the API
+        self.latest_results = {}
+        self.metrics_text = b""
+        self.durations = Histogram(
+            "k8shealthcheck_check_duration_seconds",
+            "Time taken to evaluate each health check from the cached state.",
+        )
+
+    def cached_informers(self):
+        """Informers kept in the on-disk cache, with their record types."""
+        if not hc.resource_cache_directory:
+            return []
+        return [(self.node_informer, hc.NodeRecord), (self.backup_informer, hc.BackupRecord)]
+
+    def start(self):
+        # Resume from the on-disk cache, so a restart WATCHes instead of re-listing
+        for informer, record_type in self.cached_informers():
+            if cache.load_cache(informer, record_type):
+                print_color(f"# Resumed {informer.name} from the cache #", NC)
+        for informer in self.informers:
+            informer.start(self.stop)
+
+    def save_caches(self):
+        for informer, record_type in self.cached_informers():
+            if informer.synced.is_set():
+                cache.save_cache(informer, record_type)
+
+    def wait_for_sync(self, timeout=None):
+        """Wait until every informer has completed its first LIST."""
+        return all(informer.synced.wait(timeout) for informer in self.informers)
+
+    def summary(self):
+        """
+        Return the current status of each check without walking the caches.
+        The backup status considers the newest backup of each schedule.
+        Returns:
+          A dict mapping each check name to "PASSED" or "FAILED".
+        """
+        nodes_failed = not self.node_informer.store or self.state.any_failing(["nodes"])
+        pods_failed = self.state.any_failing(
+            [informer.name for informer in self.pod_informers]
+        )
+        backup_failed = self.state.backups_failing()
+        tracked = {
+            "nodes": "FAILED" if nodes_failed else "PASSED",
+            "pods": "FAILED" if pods_failed else "PASSED",
+            "backup": "FAILED" if backup_failed else "PASSED",
+        }
+        # Other checks report the status of the last refresh
+        return {
+            check.name: tracked.get(check.name)
+            or self.latest_results.get(check.name, ("FAILED", []))[0]
+            for check in hc.CHECKS
+        }
+
+    def resources(self):
+        """
+        Snapshot the cached records of each resource checks can read.
+        Returns:
+          A dict mapping each `healthcheck.RESOURCES` name to a list of records.
+        """
+        resources = {
+            "nodes": self.node_informer.records(),
+            "pods": [
+                record for informer in self.pod_informers for record in informer.records()
+            ],
+            "backups": self.backup_informer.records(),
+        }
+        # Resources without an informer, such as AWS subnets, are fetched on
+        # demand; their fetch function caches them between refreshes
+        for check in hc.CHECKS:
+            for name in check.resources:
+                if name not in resources:
+                    try:
+                        resources[name] = hc.RESOURCES[name]()
+                    except Exception as e:
+                        print_color(f"Error while fetching {name}: {str(e)}", RED)
+        return resources
+
+    @staticmethod
+    def evaluate(check, resources):
+        # A check whose resources could not be fetched fails
+        if any(name not in resources for name in check.resources):
+            return "FAILED", []
+        return check.evaluate(*(resources[name] for name in check.resources))
+
+    def results(self):
+        """
+        Build the full check results from the cached records, without any API call.
+        Returns:
+          A dict mapping each check name to its (status, table_output) result,
+          in the same shape as `healthcheck.run_checks`.
+        """
+        resources = self.resources()
+        return {
+            check.name: self.evaluate(check, resources) for check in hc.CHECKS
+        }
+
+    def refresh(self):
+        """
+        Re-evaluate every check from the cached records, record how long each
+        took, and pre-render the /metrics response so scrapes are served as-is.
+        """
+        resources = self.resources()
+        results = {}
+        for check in hc.CHECKS:
+            started = time.perf_counter()
+            results[check.name] = hc.run_quietly(self.evaluate, check, resources)
+            self.durations.observe(check.name, time.perf_counter() - started)
+        self.latest_results = results
+        self.metrics_text = render_metrics(
+            {check: status for check, (status, _) in results.items()},
+            resources["nodes"],
+            resources["pods"],
+            self.state.newest_backups(),
+            self.durations,
+        )
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+                self.save_caches()
+            except Exception as e:
+                print_color(f"Error while refreshing health state: {str(e)}", RED)
+            if self.stop.wait(refresh_interval):
+                return
+
+    def run_forever(self, cluster_name):
+        """
+        Keep the caches in sync, serve /metrics and /healthz, and generate a
+        report every `report_interval` seconds.
+        """
+        self.start()
+        start_metrics_server(self)
+        self.wait_for_sync()
+        threading.Thread(
+            target=self._refresh_loop, name="refresh", daemon=True
+        ).start()
+        print_color("# Caches synced #", NC)
+        for check, status in self.summary().items():
+            print_color(f"{check}: {status}", GREEN if status == "PASSED" else RED)
+        while not self.stop.wait(report_interval or None):
+            start_time = datetime.now()
+            # Each scheduled report starts a new API request budget
+            hc.reset_request_budget()
+            try:
+                hc.generate_report(cluster_name, self.results(), start_time)
+            except Exception as e:
+                print_color(f"Error while generating scheduled report: {str(e)}", RED)
+
+
+if __name__ == "__main__":
+    cluster_name = os.environ.get("cluster_name")
+    print_color(
+        f"####################### Starting Health Daemon for {cluster_name} cluster #######################",
+        GREEN,
+    )
+    try:
+        HealthDaemon().run_forever(cluster_name)
+    except KeyboardInterrupt:
+        print_color("\nKeyboard interruption detected. Exiting gracefully.", RED)
+        exit(1)
@@ -1,39 +1,47 @@
 import os
+import heapq
+import json
+import queue
+import random
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from itertools import chain, count
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from termcolor import colored
 from datetime import datetime
 from colorama import init
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import (
-    SimpleDocTemplate,
-    Table,
-    TableStyle,
-    Spacer,
-    PageBreak,
-    Paragraph,
-)
-from reportlab.lib.pagesizes import letter, landscape
-from reportlab.lib.enums import TA_LEFT, TA_CENTER
-from reportlab.lib.units import inch
-from tabulate import tabulate
-import boto3
 import re
-from kubernetes import client, config
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+
+# Run as a script this module is __main__. Register it under its own name too,
+# so that mailer, cache and the other modules importing healthcheck share its
+# settings, counters and limits instead of loading a second copy.
+sys.modules.setdefault("healthcheck", sys.modules[__name__])
+
+# Heavy dependencies (kubernetes, reportlab, smtplib and the MIME classes) are
+# imported inside the functions that use them, so that importing this module
+# and runs that never reach the PDF or email stage do not pay for them.
 
 # Initialize colorama
 init()
-# Initialize Kubernetes client
-config.load_incluster_config()
 # Define constants
-NAMESPACES = [
-    "default",
-    "kube-system",
+# Namespaces to check pods in, "*" selects every namespace
+namespaces_str = os.environ.get("namespaces", "default,kube-system")
+NAMESPACES = [namespace.strip() for namespace in namespaces_str.split(",")]
+# Namespaces to leave out of the pod check
+exclude_namespaces_str = os.environ.get("exclude_namespaces", "")
+EXCLUDE_NAMESPACES = [
+    namespace.strip()
+    for namespace in exclude_namespaces_str.split(",")
+    if namespace.strip()
 ]
+# Label selector choosing namespaces to check pods in, in addition to NAMESPACES
+namespace_selector = os.environ.get("namespace_selector", "")
+# Above this many selected namespaces, pods are fetched with one cluster-wide LIST
+cluster_wide_threshold = int(os.environ.get("cluster_wide_threshold", 10))
 # Colour code
 GREEN = "green"
 RED = "red"
@@ -49,334 +57,2323 @@ recipients = recipients_str.split(",") if recipients_str else []
 minimum_eks_version = float(os.environ.get("minimum_eks_version", 0))
 # AWS SPECIFIC
 cloud_provider = os.environ.get("CLOUD_PROVIDER")
+# Comma-separated AWS regions the subnet check scans, empty for the region of the IAM role
+aws_regions_str = os.environ.get("aws_regions", "")
+AWS_REGIONS = [region.strip() for region in aws_regions_str.split(",") if region.strip()]
+# Subnets with fewer free IP addresses than this fail the subnet check
+subnet_min_free_ips = int(os.environ.get("subnet_min_free_ips", 20))
+# Seconds subnet and ENI scans of a region are reused for
+subnet_cache_ttl = float(os.environ.get("subnet_cache_ttl", 300))
+# Node CPU or memory use, in percent of allocatable, that fails the resource usage check
+resource_usage_threshold = float(os.environ.get("resource_usage_threshold", 90))
+# Pods listed as the top CPU and memory users
+resource_top_pods = int(os.environ.get("resource_top_pods", 5))
+# Seconds a single check may run before it is reported as failed
+check_timeout = float(os.environ.get("check_timeout", 300))
+# Number of pods requested per LIST call
+pod_page_size = int(os.environ.get("pod_page_size", 500))
+# Pod LIST calls run at the same time by the sharded pod scan, 1 scans sequentially
+pod_scan_workers = int(os.environ.get("pod_scan_workers", 1))
+# Namespaces split into label shards for the sharded scan, e.g.
+# "prod=app:web,api,worker;staging=tier:frontend": one shard per value plus one
+# "app notin (web,api,worker)" shard for the remaining pods
+namespace_shards_str = os.environ.get("namespace_shards", "")
+NAMESPACE_SHARDS = {
+    namespace.strip(): (
+        label.split(":", 1)[0].strip(),
+        [value.strip() for value in label.split(":", 1)[1].split(",") if value.strip()],
+    )
+    for namespace, label in (
+        shard.split("=", 1) for shard in namespace_shards_str.split(";") if "=" in shard
+    )
+    if ":" in label
+}
+# Add a "Performance" section with the per-stage breakdown to the report
+perf_report = os.environ.get("perf_report", "false").lower() == "true"
+# Report format: pdf, or html, csv or json to stream the report to disk
+report_format = os.environ.get("report_format", "pdf").lower()
+# Pods restarted this many times or more are reported as unhealthy
+pod_restart_threshold = int(os.environ.get("pod_restart_threshold", 10))
+# Seconds an OOM kill of a container that is running again keeps its pod reported as unhealthy
+pod_oom_kill_window = float(os.environ.get("pod_oom_kill_window", 86400))
+# Clusters with more nodes than this get one node table row per node group instead of per node
+node_table_limit = int(os.environ.get("node_table_limit", 100))
+# Healthy pods listed in the report, the rest are only counted; failing pods are always listed
+report_healthy_pod_rows = int(os.environ.get("report_healthy_pod_rows", 500))
+# Rows per PDF table chunk, so a long table is laid out a page at a time
+pdf_table_rows = int(os.environ.get("pdf_table_rows", 40))
+# Where the snapshot of the previous run is kept: "file", "configmap", or empty to always report everything
+snapshot_store = os.environ.get("snapshot_store", "").lower()
+# Directory of snapshot files when snapshot_store is "file"
+snapshot_directory = os.environ.get("snapshot_directory", output_directory)
+# Namespace of snapshot ConfigMaps when snapshot_store is "configmap"
+snapshot_namespace = os.environ.get("snapshot_namespace", "default")
+# SQLite file every run's results are appended to, empty keeps no history
+history_database = os.environ.get("history_database", "")
+# Days of runs kept in the history, older runs are deleted after each run
+history_retention_days = float(os.environ.get("history_retention_days", 90))
+# Directory nodes and Velero backups are cached in between runs, empty to list them in full every run
+resource_cache_directory = os.environ.get("resource_cache_directory", "")
+# Seconds a cached resource is watched for changes; after longer gaps only the changed objects are fetched
+resource_cache_watch_seconds = int(os.environ.get("resource_cache_watch_seconds", 2))
+# Days an unused cache file is kept
+resource_cache_ttl = float(os.environ.get("resource_cache_ttl", 7))
+# Velero backups requested per LIST call
+velero_page_size = int(os.environ.get("velero_page_size", 200))
+# Newest backups reported for each Velero schedule
+velero_backups_per_schedule = int(os.environ.get("velero_backups_per_schedule", 1))
+# Comma-separated Velero schedules to check, empty for all backups
+velero_schedules_str = os.environ.get("velero_schedules", "")
+VELERO_SCHEDULES = [
+    schedule.strip()
+    for schedule in velero_schedules_str.split(",")
+    if schedule.strip()
+]
+# Label Velero puts on backups created by a schedule
+VELERO_SCHEDULE_LABEL = "velero.io/schedule-name"
+# Comma-separated checks to run, in report order
+enabled_checks_str = os.environ.get("enabled_checks", "nodes,pods,backup")
+# Connections kept open to the apiserver, sized for the checks running concurrently
+api_pool_size = int(os.environ.get("api_pool_size", 10))
+# Average Kubernetes API calls per second to each apiserver, and the burst allowed above it
+api_qps = float(os.environ.get("api_qps", 50))
+api_burst = int(os.environ.get("api_burst", 100))
+# Attempts at an API call that is throttled (429) or fails transiently (5xx, connection errors)
+api_retries = int(os.environ.get("api_retries", 5))
+# Base and largest delay, in seconds, between attempts when the apiserver sends no Retry-After
+api_backoff = float(os.environ.get("api_backoff", 1))
+api_max_backoff = float(os.environ.get("api_max_backoff", 60))
+# Most API calls made to one apiserver in a run, or between two daemon reports, WATCH requests
+# excluded; 0 for no limit
+api_request_budget = int(os.environ.get("api_request_budget", 0))
+# Comma-separated kubeconfig contexts to check in one run, empty for the current cluster only
+kube_contexts_str = os.environ.get("kube_contexts", "")
+KUBE_CONTEXTS = [
+    context.strip() for context in kube_contexts_str.split(",") if context.strip()
+]
+# Clusters checked at the same time in multi-cluster mode
+cluster_workers = int(os.environ.get("cluster_workers", 8))
+
+
+# Per-thread switch used to silence check output, e.g. for background refreshes
+_output = threading.local()
 
 
 # Function to print messages with color
 def print_color(message, color):
-    print(colored(message, color))
+    if not getattr(_output, "quiet", False):
+        print(colored(message, color))
+
+
+# Function to run a callable with print_color silenced on the current thread
+def run_quietly(func, *args, **kwargs):
+    _output.quiet = True
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _output.quiet = False
+
+
+# Performance counters of the current run, keyed by stage: a check name,
+# "report_tables", "pdf_build" or "smtp_send"
+perf_stats = {}
+_perf_lock = threading.Lock()
+# Per-thread reference to the counters of the stage running on that thread
+_perf = threading.local()
+
+
+# Function to measure a stage of the run
+@contextmanager
+def perf_stage(name):
+    """
+    Record wall time, API calls, time spent waiting on and decoding API
+    responses, bytes received, objects listed and calls throttled by the
+    apiserver for a stage of the run.
+    API calls made on the current thread inside the block count towards it.
+    """
+    stats = {
+        "wall_time": 0.0,
+        "api_calls": 0,
+        "api_time": 0.0,
+        "decode_time": 0.0,
+        "bytes_received": 0,
+        "objects": 0,
+        "throttled": 0,
+    }
+    with _perf_lock:
+        perf_stats[name] = stats
+    previous = getattr(_perf, "stats", None)
+    _perf.stats = stats
+    started = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats["wall_time"] = time.perf_counter() - started
+        _perf.stats = previous
+
+
+# Function to add to the counters of the stage running on the current thread
+def _count_perf(**increments):
+    stats = getattr(_perf, "stats", None)
+    if stats is not None:
+        # Pod scan workers count towards the stage of the thread that started them
+        with _perf_lock:
+            for key, value in increments.items():
+                stats[key] += value
+
+
+# Function to snapshot the performance counters with rounded timings
+def get_perf_stats():
+    with _perf_lock:
+        return {
+            name: {
+                key: round(value, 4) if isinstance(value, float) else value
+                for key, value in stats.items()
+            }
+            for name, stats in perf_stats.items()
+        }
+
+
+# Function to print the performance breakdown as structured JSON
+def emit_perf_stats(cluster_name):
+    print(json.dumps({"cluster": cluster_name, "performance": get_perf_stats()}))
+
+
+# Shared Kubernetes API client, created on first use by get_api_client()
+_api_client = None
+_api_client_lock = threading.Lock()
+
+
+# Function to build a token refresh hook that only re-reads a rotated token
+def _token_refresher(token_filename):
+    """
+    Return a `refresh_api_key_hook` that reloads the service account token
+    only when the projected token file has been rotated. The hook runs before
+    every request, so it only compares the file's modification time.
+    """
+    last_mtime = [os.stat(token_filename).st_mtime]
+
+    def refresh(configuration):
+        mtime = os.stat(token_filename).st_mtime
+        if mtime == last_mtime[0]:
+            return
+        with open(token_filename) as f:
+            token = f.read().strip()
+        if token:
+            configuration.api_key["authorization"] = "bearer " + token
+            last_mtime[0] = mtime
+
+    return refresh
 
 
-# def list_aws_subnets(profile):
-#     try:
-#         # Check if the cloud provider is AWS
-#         if cloud_provider != "aws":
-#             print("Cloud provider is not AWS. Skipping AWS-related code.")
-#             return None, "SKIPPED"
+# Function to build a pooled API client
+def build_api_client(context=None):
+    """
+    Build an `ApiClient` with a pool of keep-alive connections sized for
+    concurrent checks, so TLS handshakes to the apiserver are not repeated
+    for every call.
+    Args:
+      context: A kubeconfig context to connect to. When None, the service
+        account is used when running in a pod and the current kubeconfig
+        context otherwise.
+    Returns:
+      A `kubernetes.client.ApiClient` instance.
+    """
+    from kubernetes import client, config
+    from kubernetes.config import incluster_config
+    from urllib3.connection import HTTPConnection
+
+    configuration = client.Configuration()
+    if context is not None:
+        config.load_kube_config(context=context, client_configuration=configuration)
+    else:
+        try:
+            config.load_incluster_config(
+                client_configuration=configuration, try_refresh_token=False
+            )
+            configuration.refresh_api_key_hook = _token_refresher(
+                incluster_config.SERVICE_TOKEN_FILENAME
+            )
+        except config.ConfigException:
+            config.load_kube_config(client_configuration=configuration)
+    configuration.connection_pool_maxsize = api_pool_size
+    api_client = client.ApiClient(configuration)
+    # Enable TCP keep-alive on pooled connections so idle ones survive
+    api_client.rest_client.pool_manager.connection_pool_kw["socket_options"] = (
+        HTTPConnection.default_socket_options
+        + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    )
+    return api_client
+
+
+# Function to get the API client shared by all checks
+def get_api_client():
+    """
+    Return the `ApiClient` shared by all checks, creating it on first use.
+    The configuration is loaded once for the whole run.
+    Returns:
+      A `kubernetes.client.ApiClient` instance.
+    """
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None:
+            _api_client = build_api_client()
+        return _api_client
+
+
+# Compact records holding only the fields the checks read from the API objects
+class NodeRecord:
+    __slots__ = (
+        "name",
+        "ready",
+        "kubelet_version",
+        "allocatable_cpu",
+        "allocatable_memory",
+        "minor_version",
+        "nodegroup",
+        "instance_type",
+    )
+
+    def __init__(
+        self,
+        name,
+        ready,
+        kubelet_version,
+        allocatable_cpu="",
+        allocatable_memory="",
+        minor_version=None,
+        nodegroup="-",
+        instance_type="-",
+    ):
+        self.name = name
+        self.ready = ready
+        self.kubelet_version = kubelet_version
+        self.allocatable_cpu = allocatable_cpu
+        self.allocatable_memory = allocatable_memory
+        # "major.minor" of the kubelet version, "N/A" when it is unknown
+        self.minor_version = minor_version or kubelet_minor_version(kubelet_version)
+        # Node pool and instance type labels, "-" when a node has none
+        self.nodegroup = nodegroup
+        self.instance_type = instance_type
+
+
+class PodRecord:
+    __slots__ = (
+        "namespace",
+        "name",
+        "phase",
+        "cpu_requests",
+        "memory_requests",
+        "ready",
+        "restarts",
+        "reason",
+        "owner",
+    )
+
+    def __init__(
+        self,
+        namespace,
+        name,
+        phase,
+        cpu_requests=(),
+        memory_requests=(),
+        ready=True,
+        restarts=0,
+        reason="",
+        owner="",
+    ):
+        self.namespace = namespace
+        self.name = name
+        self.phase = phase
+        # Quantity strings of each container's requests, "" when a container has none
+        self.cpu_requests = cpu_requests
+        self.memory_requests = memory_requests
+        # Whether every container is ready, and their restarts added up
+        self.ready = ready
+        self.restarts = restarts
+        # First waiting or terminated reason of a container, e.g. "CrashLoopBackOff"
+        self.reason = reason
+        # Controlling workload, e.g. "Deployment/web", "" for bare pods
+        self.owner = owner
+
+
+class BackupRecord:
+    __slots__ = ("name", "phase", "creation_timestamp", "schedule")
+
+    def __init__(self, name, phase, creation_timestamp, schedule=""):
+        self.name = name
+        self.phase = phase
+        self.creation_timestamp = creation_timestamp
+        self.schedule = schedule
+
+
+# Labels naming the node pool of a node, in order of preference
+NODEGROUP_LABELS = [
+    "eks.amazonaws.com/nodegroup",
+    "alpha.eksctl.io/nodegroup-name",
+    "karpenter.sh/nodepool",
+    "karpenter.sh/provisioner-name",
+]
+INSTANCE_TYPE_LABELS = ["node.kubernetes.io/instance-type", "beta.kubernetes.io/instance-type"]
 
-#         print("# Checking Subnet Count #")
 
-#         # Get the region from the IAM role
-#         region = boto3.session.Session().region_name
-#         if not region:
-#             error_message = "Failed to retrieve AWS region from IAM role."
-#             print(error_message)
-#             return None, "FAILED"
+# Function to extract the "major.minor" part of a kubelet version, once per distinct version
+@lru_cache(maxsize=None)
+def kubelet_minor_version(version):
+    version_match = re.search(r"(\d+\.\d+)", version)
+    return version_match.group(1) if version_match else "N/A"
 
-#         # Initialize Boto3 session with IAM role credentials
-#         session = boto3.Session(region_name=region)
 
-#         ec2 = session.client("ec2")
-#         vpc_ids = ec2.describe_vpcs()["Vpcs"]
-#         vpc_id = vpc_ids[0]["VpcId"]
+# Function to tell whether a container's last termination is an OOM kill worth reporting
+def recent_oom_kill(last_terminated, restarts):
+    """
+    lastState keeps a container's last termination until it terminates again,
+    so an OOM kill only counts while it is recent or the container keeps restarting.
+    Args:
+      last_terminated: The lastState.terminated of a container status.
+      restarts: The restartCount of the container.
+    Returns:
+      True if the container was OOM killed within pod_oom_kill_window seconds,
+      or restarted pod_restart_threshold times or more after an OOM kill.
+    """
+    if last_terminated.get("reason") != "OOMKilled":
+        return False
+    if restarts >= pod_restart_threshold:
+        return True
+    finished_at = last_terminated.get("finishedAt")
+    if not finished_at:
+        return False
+    finished = datetime.fromisoformat(finished_at.replace("Z", "+00:00"))
+    return (datetime.now().astimezone() - finished).total_seconds() <= pod_oom_kill_window
+
+
+# Functions to project raw JSON objects onto compact records
+def node_record(node):
+    status = node.get("status", {})
+    conditions = status.get("conditions") or []
+    ready = any(
+        condition["type"] == "Ready" and condition["status"] == "True"
+        for condition in conditions
+    )
+    node_info = status.get("nodeInfo") or {}
+    allocatable = status.get("allocatable") or {}
+    labels = node["metadata"].get("labels") or {}
+    kubelet_version = node_info.get("kubeletVersion") or "N/A"
+    return NodeRecord(
+        node["metadata"]["name"],
+        ready,
+        kubelet_version,
+        allocatable.get("cpu", ""),
+        allocatable.get("memory", ""),
+        kubelet_minor_version(kubelet_version),
+        next((labels[label] for label in NODEGROUP_LABELS if labels.get(label)), "-"),
+        next((labels[label] for label in INSTANCE_TYPE_LABELS if labels.get(label)), "-"),
+    )
+
+
+def pod_record(pod):
+    metadata = pod["metadata"]
+    status = pod.get("status") or {}
+    requests = [
+        (container.get("resources") or {}).get("requests") or {}
+        for container in (pod.get("spec") or {}).get("containers") or []
+    ]
+    # Reduce the container statuses to readiness, restarts and the first problem reason
+    container_statuses = status.get("containerStatuses") or []
+    ready = bool(container_statuses)
+    restarts = 0
+    reason = ""
+    for container in container_statuses:
+        ready = ready and bool(container.get("ready"))
+        restarts += container.get("restartCount") or 0
+        state = container.get("state") or {}
+        waiting = (state.get("waiting") or {}).get("reason")
+        terminated = (state.get("terminated") or {}).get("reason")
+        last_terminated = (container.get("lastState") or {}).get("terminated") or {}
+        reason = (
+            reason
+            or waiting
+            or (terminated if terminated != "Completed" else "")
+            or ("OOMKilled" if recent_oom_kill(last_terminated, container.get("restartCount") or 0) else "")
+        )
+    # Collapse ReplicaSet owners onto their Deployment
+    owner = ""
+    for reference in metadata.get("ownerReferences") or []:
+        if reference.get("controller"):
+            kind, name = reference["kind"], reference["name"]
+            template_hash = (metadata.get("labels") or {}).get("pod-template-hash")
+            if kind == "ReplicaSet" and template_hash and name.endswith(f"-{template_hash}"):
+                kind, name = "Deployment", name[: -len(template_hash) - 1]
+            owner = f"{kind}/{name}"
+            break
+    return PodRecord(
+        metadata["namespace"],
+        metadata["name"],
+        status.get("phase") or "Unknown",
+        tuple(request.get("cpu", "") for request in requests),
+        tuple(request.get("memory", "") for request in requests),
+        ready,
+        restarts,
+        reason,
+        owner,
+    )
+
+
+def backup_record(backup):
+    return BackupRecord(
+        backup["metadata"]["name"],
+        backup.get("status", {}).get("phase") or "Unknown",
+        backup["metadata"]["creationTimestamp"],
+        (backup["metadata"].get("labels") or {}).get(VELERO_SCHEDULE_LABEL, ""),
+    )
+
+
+class RequestBudgetExceeded(Exception):
+    """Raised instead of calling an apiserver whose request budget for the run is spent."""
+
+
+class TokenBucket:
+    """
+    Allow `rate` calls per second on average, with bursts of up to `burst`
+    calls. Callers reserve a token and sleep until it is due, so waiting
+    threads are served in order.
+    """
 
-#         subnets = ec2.describe_subnets(Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])["Subnets"]
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ApiServerLimits:
+    """The rate limit and request budget of one apiserver."""
+
+    def __init__(self):
+        self.bucket = TokenBucket(api_qps, api_burst)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            if api_request_budget and self.requests >= api_request_budget:
+                raise RequestBudgetExceeded(
+                    f"The budget of {api_request_budget} API calls for this run is spent"
+                )
+            self.requests += 1
+
+    def spent(self):
+        with self.lock:
+            return bool(api_request_budget) and self.requests >= api_request_budget
+
+
+# Limits of each apiserver by host, shared by every check and thread of the run
+_api_server_limits = {}
+_api_server_limits_lock = threading.Lock()
 
-#         # Prepare data for the subnet table
-#         subnet_table_data = []
-#         header = ["Name", "Subnet ID", "Total IPs", "Used IPs", "Free IPs"]
-#         subnet_table_data.append(header)
 
-#         for subnet in subnets:
-#             name = next((tag["Value"] for tag in subnet.get("Tags", []) if tag["Key"] == "Name"), None)
-#             enis = ec2.describe_network_interfaces(Filters=[{"Name": "subnet-id", "Values": [subnet["SubnetId"]]}])["NetworkInterfaces"]
-#             used_ips = str(len(enis))
-#             free_ips = subnet["AvailableIpAddressCount"]
-#             total_ips = int(used_ips) + free_ips
-#             row_data = [name, subnet["SubnetId"], total_ips, used_ips, free_ips]
-#             subnet_table_data.append(row_data)
+# Function to get the limits of the apiserver an API method calls
+def api_server_limits(api_func):
+    # Methods of the API classes, or of the ApiClient itself for raw requests
+    owner = getattr(api_func, "__self__", None)
+    api_client = getattr(owner, "api_client", owner)
+    host = getattr(getattr(api_client, "configuration", None), "host", "")
+    with _api_server_limits_lock:
+        if host not in _api_server_limits:
+            _api_server_limits[host] = ApiServerLimits()
+        return _api_server_limits[host]
 
-#         # Calculate subnet_status based on your criteria
-#         subnet_status = "PASSED" if all(subnet["AvailableIpAddressCount"] >= 20 for subnet in subnets) else "FAILED"
 
-#         print("# Subnet calculations completed #")
-#         return subnet_table_data, subnet_status
-#     except Exception as e:
-#         print(f"Error listing subnets: {str(e)}")
-#         return None, "FAILED"
+# Function to start a new request budget, e.g. for each scheduled report of the daemon
+def reset_request_budget():
+    with _api_server_limits_lock:
+        for limits in _api_server_limits.values():
+            with limits.lock:
+                limits.requests = 0
 
 
-# Function to check if nodes are in a ready state
-def check_nodes_ready():
+# Function to tell whether an apiserver's request budget is spent, e.g. for /healthz
+def request_budget_spent():
+    with _api_server_limits_lock:
+        return any(limits.spent() for limits in _api_server_limits.values())
+
+
+# Function to read the delay a throttled response asks for
+def retry_after_seconds(error):
     """
-    Checks the status of all nodes in the cluster and returns
-    `True` if all nodes are ready, `False` if one or more nodes are not ready,
-    and a list of nodes that are not ready.
+    Args:
+      error: A kubernetes `ApiException`.
+    Returns:
+      The seconds given by its Retry-After header, either delta-seconds or
+      an HTTP date, or None when it has none.
     """
-    # Initialize lists to collect node information
-    ready_nodes = []
-    not_ready_nodes = []
-    print_color("# Checking Node Status #", NC)
+    from email.utils import parsedate_to_datetime
+
+    value = ((getattr(error, "headers", None) or {}).get("Retry-After") or "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
     try:
-        # Load Kubernetes configuration from service account
-        config.load_incluster_config()
+        return max((parsedate_to_datetime(value) - datetime.now().astimezone()).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
 
-        # Initialize Kubernetes API client
-        api = client.CoreV1Api()
 
-        # Get the list of nodes
-        nodes = api.list_node().items
+# Function to call the Kubernetes API within the rate limit, budget and retry policy
+def call_api(api_func, *args, on_throttled=None, **kwargs):
+    """
+    Call a kubernetes client method through the request layer shared by all
+    checks. Each attempt waits for a token of the apiserver's `TokenBucket`
+    and is charged to its request budget, except WATCH requests: the daemon
+    keeps them open for its whole life, so charging them would spend the
+    budget of a run on reconnects. Responses throttled by API
+    Priority and Fairness (429) and transient failures (500, 502, 503, 504
+    and connection errors) are retried up to api_retries times, after the
+    Retry-After delay when the apiserver sends one and with exponential
+    backoff and jitter otherwise.
+    Args:
+      api_func: A bound kubernetes client method.
+      on_throttled: Called without arguments on every 429, e.g. to lower a
+        concurrency limit.
+      *args, **kwargs: Arguments passed through to `api_func`.
+    Returns:
+      What `api_func` returns.
+    Raises:
+      RequestBudgetExceeded: The apiserver's request budget is spent.
+      kubernetes.client.rest.ApiException: The call failed permanently, or
+        still failed after the last attempt.
+    """
+    from kubernetes.client.rest import ApiException
+    from urllib3.exceptions import HTTPError
+
+    limits = api_server_limits(api_func)
+    attempt = 0
+    while True:
+        attempt += 1
+        if not kwargs.get("watch"):
+            limits.spend()
+        limits.bucket.acquire()
+        try:
+            return api_func(*args, **kwargs)
+        except ApiException as e:
+            if e.status not in (429, 500, 502, 503, 504) or attempt >= api_retries:
+                raise
+            if e.status == 429:
+                _count_perf(throttled=1)
+                if on_throttled:
+                    on_throttled()
+            delay = retry_after_seconds(e)
+        except HTTPError:
+            if attempt >= api_retries:
+                raise
+            delay = None
+        if delay is None:
+            delay = api_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+        time.sleep(min(delay, api_max_backoff))
+
+
+# Function to call a LIST endpoint without OpenAPI model deserialization
+def list_raw(list_func, *args, on_throttled=None, **kwargs):
+    """
+    Call a kubernetes client LIST method and decode the response body as plain JSON.
+    Building V1Node/V1Pod object graphs dominates CPU time on large clusters,
+    while the checks only read a handful of fields, so the body is decoded
+    into dicts and projected onto compact records by the caller.
+    The call goes through `call_api`, so it is rate limited and retried.
+    Args:
+      list_func: A bound kubernetes client method, e.g. `CoreV1Api().list_node`.
+      on_throttled: Passed to `call_api`.
+      *args, **kwargs: Arguments passed through to `list_func`.
+    Returns:
+      The decoded list object as a dict.
+    """
+    started = time.perf_counter()
+    response = call_api(
+        list_func, *args, on_throttled=on_throttled, _preload_content=False, **kwargs
+    )
+    try:
+        data = response.data
+    finally:
+        response.release_conn()
+    received = time.perf_counter()
+    decoded = json.loads(data)
+    _count_perf(
+        api_calls=1,
+        api_time=received - started,
+        decode_time=time.perf_counter() - received,
+        bytes_received=len(data),
+    )
+    return decoded
+
+
+# Function to stream the items of a LIST endpoint page by page
+def iter_list_raw(list_func, *args, page_size=None, **kwargs):
+    """
+    Yield the raw items of a LIST endpoint, following `continue` tokens.
+    Args:
+      list_func: A bound kubernetes client method.
+      page_size: The number of items requested per LIST call, or None for no limit.
+      *args, **kwargs: Arguments passed through to `list_func`.
+    Yields:
+      Each item of each page as a dict.
+    """
+    _continue = None
+    while True:
+        if page_size:
+            kwargs["limit"] = page_size
+        page = list_raw(list_func, *args, _continue=_continue, **kwargs)
+        items = page.get("items") or []
+        _count_perf(objects=len(items))
+        yield from items
+        _continue = page.get("metadata", {}).get("continue")
+        if not _continue:
+            break
+
+
+# Function to evaluate node readiness
+def evaluate_nodes(nodes, table_limit=node_table_limit):
+    """
+    Evaluate the readiness and kubelet versions of a list of node records.
+    Clusters of up to `table_limit` nodes get one row per node. Larger ones
+    get one row per node group and instance type with its kubelet minor
+    versions and ready count, built in a single pass; only the nodes that
+    are not ready are listed below their group. Groups are not keyed by
+    version, so a version change shows up as drift of the same row.
+    Args:
+      nodes: A list of `NodeRecord` instances.
+      table_limit: Largest number of nodes listed one per row, a negative
+        value always lists every node.
+    Returns:
+      A ("PASSED" or "FAILED", node_table_output) tuple.
+    """
+    nodes = [node for node in nodes if not node.name.startswith("fargate")]
+    if not nodes:
+        print_color("No nodes found.", RED)
+        return "FAILED", []
 
-        if not nodes:
-            print_color("No nodes found.", RED)
-            return "FAILED", []
-        # Calculate column widths based on the longest values
-        max_node_name_width = max(len(node.metadata.name) for node in nodes)
-        max_status_width = len("Status")
-        max_version_width = len("Version")
-        # Create a list to store the rows of the table
-        node_table_output = []
-        # Print the table header with "Name", "Status", and "Version" (only once)
-        node_table_output.append(
+    # (nodegroup, instance type) -> [ready nodes, (name, version) of nodes not ready,
+    # number of nodes per minor version]
+    groups = {}
+    for node in nodes:
+        group = groups.get((node.nodegroup, node.instance_type))
+        if group is None:
+            group = groups[(node.nodegroup, node.instance_type)] = [0, [], {}]
+        if node.ready:
+            group[0] += 1
+        else:
+            group[1].append((node.name, node.minor_version))
+        group[2][node.minor_version] = group[2].get(node.minor_version, 0) + 1
+
+    if 0 <= table_limit < len(nodes):
+        header = ["Name", "Version", "Node Group", "Instance Type", "Ready", "Status"]
+        rows = []
+        for (nodegroup, instance_type), (ready, not_ready, group_versions) in groups.items():
+            # A group is named by its node group and instance type, stable across runs
+            rows.append(
+                [
+                    f"{nodegroup}/{instance_type}",
+                    ", ".join(sorted(group_versions)),
+                    nodegroup,
+                    instance_type,
+                    f"{ready}/{ready + len(not_ready)}",
+                    "Not Ready" if not_ready else "Ready",
+                ]
+            )
+            # Drill down into unhealthy groups only
+            rows.extend(
+                [f"  {name}", version, nodegroup, instance_type, "-", "Not Ready"]
+                for name, version in not_ready
+            )
+    else:
+        header = ["Name", "Version", "Node Group", "Instance Type", "Status"]
+        rows = [
             [
-                "Name".ljust(max_node_name_width),
-                "Version".ljust(max_version_width),
-                "Status".ljust(max_status_width),
+                node.name,
+                node.minor_version,
+                node.nodegroup,
+                node.instance_type,
+                "Ready" if node.ready else "Not Ready",
             ]
+            for node in nodes
+        ]
+
+    # Pad the table now that the final widths are known
+    widths = [max(len(cell) for cell in column) for column in zip(header, *rows)]
+    node_table_output = [
+        [cell.ljust(width) for cell, width in zip(row, widths)] for row in [header, *rows]
+    ]
+
+    # Report each outdated group once instead of once per node
+    versions = {}
+    for (nodegroup, instance_type), (_, _, group_versions) in groups.items():
+        for version, node_count in group_versions.items():
+            versions[version] = versions.get(version, 0) + node_count
+            if version_below_minimum(version):
+                print_color(
+                    f"Node group '{nodegroup}/{instance_type}' has {node_count} nodes on a version below {minimum_eks_version} i.e {version}",
+                    RED,
+                )
+    if len(versions) > 1:
+        skew = ", ".join(f"{version} ({node_count} nodes)" for version, node_count in sorted(versions.items()))
+        print_color(f"Nodes run several kubelet minor versions: {skew}", NC)
+
+    # Check if any node is not ready and return result accordingly
+    not_ready_nodes = [name for _, not_ready, _ in groups.values() for name, _ in not_ready]
+    if not_ready_nodes:
+        result = f"Some nodes are not in a ready state: {', '.join(not_ready_nodes)}"
+        print_color(result, RED)
+        return "FAILED", node_table_output
+    else:
+        result = "All nodes are in a ready state."
+        print_color(result, GREEN)
+        return "PASSED", node_table_output
+
+
+# Function to evaluate node kubelet versions
+def evaluate_node_versions(nodes):
+    """
+    Evaluate whether every node runs at least `minimum_eks_version`.
+    Args:
+      nodes: A list of `NodeRecord` instances.
+    Returns:
+      A ("PASSED" or "FAILED", node_version_table_output) tuple.
+    """
+    rows = []
+    outdated_nodes = []
+    for node in nodes:
+        if node.name.startswith("fargate"):
+            continue
+        version = node.minor_version
+        status = "Outdated" if version_below_minimum(version) else "Supported"
+        if status == "Outdated":
+            outdated_nodes.append(node.name)
+        rows.append((node.name, version, status))
+    if not rows:
+        print_color("No nodes found.", RED)
+        return "FAILED", []
+    widths = [
+        max(len(header), *(len(row[i]) for row in rows))
+        for i, header in enumerate(["Name", "Version", "Status"])
+    ]
+    node_version_table_output = [
+        [cell.ljust(width) for cell, width in zip(row, widths)]
+        for row in [("Name", "Version", "Status"), *rows]
+    ]
+    if outdated_nodes:
+        print_color(
+            f"Some nodes run a version below {minimum_eks_version}: {', '.join(outdated_nodes)}",
+            RED,
         )
-        # Placeholder logic for node readiness checking
-        for node in nodes:
-            node_name = node.metadata.name
-            conditions = node.status.conditions
-            ready = False
-            version = (
-                node.status.node_info.kubelet_version
-                if node.status.node_info and node.status.node_info.kubelet_version
-                else "N/A"
+        return "FAILED", node_version_table_output
+    print_color(f"All nodes run version {minimum_eks_version} or later.", GREEN)
+    return "PASSED", node_version_table_output
+
+
+# Function to list the nodes of the cluster
+def fetch_nodes(api_client=None):
+    """
+    Args:
+      api_client: The `ApiClient` of the cluster to check, defaults to the shared one.
+    Returns:
+      A list of `NodeRecord` instances.
+    """
+    from kubernetes import client
+
+    # Initialize Kubernetes API client on the shared connection pool
+    api = client.CoreV1Api(api_client or get_api_client())
+
+    if resource_cache_directory:
+        from cache import cached_records
+
+        # Download only the nodes that changed since the previous run
+        return cached_records("nodes", api.list_node, node_record, NodeRecord, "/api/v1/nodes")
+
+    # Get the list of nodes as compact records
+    return [node_record(node) for node in iter_list_raw(api.list_node)]
+
+
+# Function to stream the pods of a namespace page by page
+def iter_namespaced_pods(api, namespace, page_size=pod_page_size):
+    """
+    Yield a compact record for every pod in a namespace, one LIST page at a time.
+    Args:
+      api: A `CoreV1Api` instance.
+      namespace: The namespace to list pods from.
+      page_size: The number of pods requested per LIST call.
+    Yields:
+      `PodRecord` instances. Only the current page is held in memory.
+    """
+    for pod in iter_list_raw(api.list_namespaced_pod, namespace, page_size=page_size):
+        yield pod_record(pod)
+
+
+# Function to resolve the namespaces the pod check covers
+def select_namespaces(api):
+    """
+    Resolve the namespaces to check pods in from NAMESPACES, EXCLUDE_NAMESPACES
+    and namespace_selector.
+    Args:
+      api: A `CoreV1Api` instance.
+    Returns:
+      An ordered list of namespace names, or None when every namespace not in
+      EXCLUDE_NAMESPACES is selected.
+    """
+    if "*" in NAMESPACES:
+        return None
+    selected = [namespace for namespace in NAMESPACES if namespace != ""]
+    if namespace_selector:
+        selected.extend(
+            namespace["metadata"]["name"]
+            for namespace in iter_list_raw(
+                api.list_namespace, label_selector=namespace_selector
             )
-            # Extract the version number using a regular expression
-            version_match = re.search(r"(\d+\.\d+)", version)
-            if version_match:
-                version_trimmed = version_match.group(1)
-            else:
-                version_trimmed = version
-            for condition in conditions:
-                if condition.type == "Ready" and condition.status == "True":
-                    ready = True
-            if not node_name.startswith("fargate"):
-                if ready:
-                    ready_nodes.append(node_name)
-                    node_info = (node_name, "Ready", GREEN, version_trimmed)
-                else:
-                    not_ready_nodes.append(node_name)
-                    node_info = (node_name, "Not Ready", RED, version_trimmed)
-                status_formatted = node_info[1].ljust(max_status_width)
-                version_formatted = node_info[3].ljust(max_version_width)
-                node_table_output.append(
-                    [
-                        node_info[0].ljust(max_node_name_width),
-                        version_formatted,
-                        status_formatted,
-                    ]
-                )
-                # Check if the version is below 1.25
-                if float(version_trimmed) < minimum_eks_version:
-                    print_color(
-                        f"Node '{node_name}' has a version below {minimum_eks_version} i.e {version_trimmed}",
-                        RED,
-                    )
-
-        # Check if any node is not ready and return result accordingly
-        if not_ready_nodes:
-            result = (
-                f"Some nodes are not in a ready state: {', '.join(not_ready_nodes)}"
+        )
+    # Drop duplicates and excluded namespaces, keeping the configured order
+    excluded = set(EXCLUDE_NAMESPACES)
+    return [
+        namespace
+        for namespace in dict.fromkeys(selected)
+        if namespace not in excluded
+    ]
+
+
+# Function to stream the pods of all selected namespaces
+def iter_selected_pods(api, page_size=pod_page_size):
+    """
+    Yield a compact record for every pod in the selected namespaces.
+    Small selections are listed namespace by namespace. Selections larger than
+    cluster_wide_threshold, or "*", use a single paginated cluster-wide LIST,
+    with excluded namespaces filtered server-side and the selection filtered
+    client-side. With pod_scan_workers above 1 the sharded scan is used instead.
+    Args:
+      api: A `CoreV1Api` instance.
+      page_size: The number of pods requested per LIST call.
+    Yields:
+      `PodRecord` instances.
+    """
+    if pod_scan_workers > 1:
+        yield from iter_sharded_pods(api, page_size)
+        return
+    namespaces = select_namespaces(api)
+    if namespaces is not None and len(namespaces) <= cluster_wide_threshold:
+        for namespace in namespaces:
+            yield from iter_namespaced_pods(api, namespace, page_size)
+        return
+
+    field_selector = ",".join(
+        f"metadata.namespace!={namespace}" for namespace in EXCLUDE_NAMESPACES
+    )
+    wanted = set(namespaces) if namespaces is not None else None
+    for pod in iter_list_raw(
+        api.list_pod_for_all_namespaces,
+        page_size=page_size,
+        field_selector=field_selector or None,
+    ):
+        if wanted is None or pod["metadata"]["namespace"] in wanted:
+            yield pod_record(pod)
+
+
+class AdaptiveLimit:
+    """
+    A concurrency limit adjusted with additive increase, multiplicative
+    decrease: halved whenever the apiserver throttles a call with 429, and
+    raised by one, up to `maximum`, after as many successful calls in a row.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = max(1, maximum)
+        self.limit = self.maximum
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+
+    def succeeded(self):
+        with self.condition:
+            self.successes += 1
+            if self.limit < self.maximum and self.successes >= self.limit:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+
+# Function to split the pod scan into shards
+def pod_shards(api):
+    """
+    List the shards of the sharded pod scan: one per selected namespace, and
+    one per label value, plus one for all other pods, for the namespaces in
+    NAMESPACE_SHARDS.
+    Args:
+      api: A `CoreV1Api` instance.
+    Returns:
+      A list of (namespace, label_selector) tuples, label_selector being None
+      for whole namespaces.
+    """
+    namespaces = select_namespaces(api)
+    if namespaces is None:
+        excluded = set(EXCLUDE_NAMESPACES)
+        namespaces = [
+            namespace["metadata"]["name"]
+            for namespace in iter_list_raw(api.list_namespace)
+            if namespace["metadata"]["name"] not in excluded
+        ]
+    shards = []
+    for namespace in namespaces:
+        if namespace not in NAMESPACE_SHARDS:
+            shards.append((namespace, None))
+            continue
+        key, values = NAMESPACE_SHARDS[namespace]
+        shards.extend((namespace, f"{key}={value}") for value in values)
+        # "notin" also matches pods without the label, so no pod is left out
+        shards.append((namespace, f"{key} notin ({','.join(values)})"))
+    return shards
+
+
+# Function to list one shard of pods page by page
+def scan_pod_shard(api, namespace, label_selector, limit, page_size=pod_page_size):
+    """
+    Args:
+      api: A `CoreV1Api` instance.
+      namespace: The namespace of the shard.
+      label_selector: The label selector of the shard, or None.
+      limit: The `AdaptiveLimit` shared by the shards of the scan, lowered
+        on every 429 while `call_api` retries the page.
+      page_size: The number of pods requested per LIST call.
+    Yields:
+      A list of `PodRecord` instances per page.
+    """
+    _continue = None
+    while True:
+        with limit.slot():
+            page = list_raw(
+                api.list_namespaced_pod,
+                namespace,
+                on_throttled=limit.throttled,
+                limit=page_size,
+                _continue=_continue,
+                label_selector=label_selector,
             )
-            print_color(result, RED)
-            return "FAILED", node_table_output
+        limit.succeeded()
+        items = page.get("items") or []
+        _count_perf(objects=len(items))
+        yield [pod_record(pod) for pod in items]
+        _continue = page.get("metadata", {}).get("continue")
+        if not _continue:
+            return
+
+
+# Function to stream the pods of all selected namespaces from parallel shards
+def iter_sharded_pods(api, page_size=pod_page_size, workers=pod_scan_workers):
+    """
+    Scan the shards from `pod_shards` on `workers` threads and yield their
+    pods as pages arrive. At most twice `workers` pages wait to be consumed,
+    so memory stays bounded whatever the cluster size. The number of LIST
+    calls in flight is adapted with `AdaptiveLimit`.
+    Args:
+      api: A `CoreV1Api` instance.
+      page_size: The number of pods requested per LIST call.
+      workers: The number of shards scanned at the same time.
+    Yields:
+      `PodRecord` instances, in no particular order across shards.
+    """
+    shards = queue.SimpleQueue()
+    for shard in pod_shards(api):
+        shards.put(shard)
+    pages = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+    limit = AdaptiveLimit(workers)
+    stats = getattr(_perf, "stats", None)
+
+    def put(item):
+        # Give up once the consumer has gone, e.g. after a check timeout
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def work():
+        _perf.stats = stats
+        try:
+            while not stop.is_set():
+                try:
+                    namespace, label_selector = shards.get_nowait()
+                except queue.Empty:
+                    break
+                for records in scan_pod_shard(api, namespace, label_selector, limit, page_size):
+                    if not put(records):
+                        return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    running = max(1, workers)
+    for i in range(running):
+        threading.Thread(target=work, name=f"pod-scan-{i}", daemon=True).start()
+    try:
+        while running:
+            item = pages.get()
+            if item is None:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        stop.set()
+
+
+# Function to tell why a pod is unhealthy
+def pod_problem(pod):
+    """
+    Args:
+      pod: A `PodRecord` instance.
+    Returns:
+      Why the pod is unhealthy, e.g. "Pending", "CrashLoopBackOff",
+      "OOMKilled", "NotReady" or "Restarting", or None when it is healthy.
+    """
+    if pod.phase not in ["Running", "Completed", "Succeeded"]:
+        return pod.reason or pod.phase
+    if pod.reason:
+        return pod.reason
+    if pod.phase == "Running" and not pod.ready:
+        return "NotReady"
+    if pod.restarts >= pod_restart_threshold:
+        return "Restarting"
+    return None
+
+
+# Function to evaluate pod health
+def evaluate_pods(pods, healthy_rows=report_healthy_pod_rows):
+    """
+    Evaluate the health of a stream of pod records from their phase and
+    container statuses, with one row per workload: the pods of a Deployment,
+    DaemonSet, StatefulSet or Job collapse into a single row, bare pods get
+    a row each. Only counters are kept per workload, never the pods.
+    Unhealthy workloads are always listed. Only the first `healthy_rows`
+    healthy workloads are listed, the others are summed up in one row per
+    namespace and phase, e.g. "(1200 more pods in 40 workloads)", so the table stays bounded
+    on large clusters.
+    Args:
+      pods: An iterable of `PodRecord` instances. It is consumed once, so a
+        generator streaming pods page by page can be passed directly.
+      healthy_rows: Maximum number of healthy workloads listed individually,
+        a negative value lists them all.
+    Returns:
+      A ("PASSED" or "FAILED", pod_table_output) tuple.
+    """
+    # (namespace, workload) -> [pods, healthy pods, restarts, phase, {problem: pods}]
+    workloads = {}
+    for pod in pods:
+        workload = workloads.get((pod.namespace, pod.owner or pod.name))
+        if workload is None:
+            workload = workloads[(pod.namespace, pod.owner or pod.name)] = [0, 0, 0, pod.phase, None]
+        workload[0] += 1
+        workload[2] += pod.restarts
+        problem = pod_problem(pod)
+        if problem is None:
+            workload[1] += 1
+            workload[3] = pod.phase
         else:
-            result = "All nodes are in a ready state."
-            print_color(result, GREEN)
-            return "PASSED", node_table_output
-    except Exception as e:
-        print_color("Error while checking node status:", RED)
-        print_color(str(e), RED)
+            if workload[4] is None:
+                workload[4] = {}
+            workload[4][problem] = workload[4].get(problem, 0) + 1
+
+    rows = []
+    problematic_workloads = []  # To store problematic workloads
+    listed_healthy = 0
+    # (namespace, phase) -> [healthy pods, healthy workloads] left out of the table
+    omitted = {}
+    for (namespace, name), (total, healthy, restarts, phase, problems) in workloads.items():
+        if problems:
+            # Report the most common problem of the workload
+            status = max(problems, key=problems.get)
+            problematic_workloads.append((namespace, name, status, total - healthy, total))
+        elif healthy_rows >= 0 and listed_healthy >= healthy_rows:
+            counts = omitted.setdefault((namespace, phase), [0, 0])
+            counts[0] += total
+            counts[1] += 1
+            continue
+        else:
+            status = phase
+            listed_healthy += 1
+        rows.append([namespace, name, f"{healthy}/{total}", str(restarts), status])
+    workloads.clear()
+    for (namespace, phase), (pod_count, omitted_workloads) in sorted(omitted.items()):
+        rows.append(
+            [
+                namespace,
+                f"({pod_count} more pods in {omitted_workloads} workload{'s' if omitted_workloads != 1 else ''})",
+                f"{pod_count}/{pod_count}",
+                "-",
+                phase,
+            ]
+        )
+
+    # Create a list to store the rows of the table, starting with the header,
+    # padded now that the final widths are known
+    header = ["Namespace", "Workload", "Ready", "Restarts", "Status"]
+    widths = [max(len(cell) for cell in column) for column in zip(header, *rows)]
+    widths[-1] = max(widths[-1], 10)
+    pod_table_output = [
+        [cell.ljust(width) for cell, width in zip(row, widths)] for row in [header, *rows]
+    ]
+
+    if problematic_workloads:
+        print_color("Some pods are not in Running state", RED)
+        print_color("Problematic Pods:", RED)
+        for namespace, name, status, unhealthy, total in problematic_workloads:
+            print_color(
+                f"Namespace: {namespace}, Pod: {name}, Status: {status} ({unhealthy}/{total} pods)",
+                RED,
+            )
+        return "FAILED", pod_table_output
+
+    print_color("All pods are in Running state", GREEN)
+    return "PASSED", pod_table_output
+
+
+# Function to stream the pods of the selected namespaces
+def fetch_pods(api_client=None):
+    """
+    Args:
+      api_client: The `ApiClient` of the cluster to check, defaults to the shared one.
+    Returns:
+      A generator of `PodRecord` instances, streamed page by page.
+    """
+    from kubernetes import client
+
+    # Initialize Kubernetes API client on the shared connection pool
+    api = client.CoreV1Api(api_client or get_api_client())
+
+    # Stream pod info page by page from the selected namespaces
+    return iter_selected_pods(api)
+
+
+# Function to keep the newest backups of each schedule from a stream
+def newest_backups_per_schedule(backups, per_schedule=velero_backups_per_schedule):
+    """
+    Select the newest backups of each Velero schedule in a single pass.
+    A min-heap of at most `per_schedule` entries is kept per schedule, so
+    memory grows with the number of schedules times `per_schedule` rather
+    than with the backup history.
+    Args:
+      backups: An iterable of `BackupRecord` instances, consumed once.
+      per_schedule: The number of backups to keep for each schedule.
+    Returns:
+      A list of `BackupRecord` instances ordered by schedule, newest first.
+    """
+    heaps = {}
+    # Unique tiebreaker, so entries with the same timestamp and name never compare records
+    tiebreaker = count()
+    for backup in backups:
+        heap = heaps.setdefault(backup.schedule, [])
+        entry = (backup.creation_timestamp, backup.name, next(tiebreaker), backup)
+        if len(heap) < per_schedule:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+    newest = []
+    for schedule in sorted(heaps):
+        heap = sorted(heaps[schedule], key=lambda x: x[:2], reverse=True)
+        newest.extend(entry[-1] for entry in heap)
+    return newest
+
+
+# Function to evaluate the latest Velero backups
+def evaluate_backups(backups):
+    """
+    Evaluate the newest Velero backups of each schedule.
+    Args:
+      backups: An iterable of `BackupRecord` instances. It is consumed once,
+        so a generator streaming backups page by page can be passed directly.
+    Returns:
+      A ("PASSED" or "FAILED", backup_table_output) tuple. The check fails
+      when no backup is found or a reported backup is not completed.
+    """
+    incomplete_backups = []  # To store names of incomplete backups
+
+    # Include only the newest backups of each schedule
+    backup_info = newest_backups_per_schedule(backups)
+
+    # Check if no backups are found
+    if not backup_info:
+        print_color("No backups found.", RED)
         return "FAILED", []
 
-# Function to check if pods are running
-def check_pods_running():
+    # Calculate column widths based on the longest reported values
+    max_schedule_width = max(
+        len("Schedule"), *(len(backup.schedule or "-") for backup in backup_info)
+    )
+    max_backup_name_width = max(
+        len("Name"), *(len(backup.name) for backup in backup_info)
+    )
+    max_status_width = max(10, *(len(backup.phase) for backup in backup_info))
+
+    # Create a list to store the rows of the table, starting with the header
+    backup_table_output = [
+        [
+            "Schedule".ljust(max_schedule_width),
+            "Name".ljust(max_backup_name_width),
+            "Status".ljust(max_status_width),
+        ]
+    ]
+
+    # Print backup info with proper formatting
+    for backup in backup_info:
+        if "Completed" not in backup.phase:
+            incomplete_backups.append(backup.name)
+        backup_table_output.append(
+            [
+                (backup.schedule or "-").ljust(max_schedule_width),
+                backup.name.ljust(max_backup_name_width),
+                backup.phase.ljust(max_status_width),
+            ]
+        )
+
+    # Check if any backup is not in a completed state and return result accordingly
+    if incomplete_backups:
+        print_color("Some backups are not in a completed state:", RED)
+        for backup_name in incomplete_backups:
+            print_color(f"Backup Name: {backup_name}", RED)
+        return "FAILED", backup_table_output
+
+    print_color("All backups are in a completed state", GREEN)
+    return "PASSED", backup_table_output
+
+
+# Function to build the label selector for the configured Velero schedules
+def velero_label_selector():
+    if not VELERO_SCHEDULES:
+        return None
+    return f"{VELERO_SCHEDULE_LABEL} in ({','.join(VELERO_SCHEDULES)})"
+
+
+# Function to stream the Velero backups of the configured schedules
+def fetch_backups(api_client=None):
+    """
+    Args:
+      api_client: The `ApiClient` of the cluster to check, defaults to the shared one.
+    Returns:
+      A generator of `BackupRecord` instances, streamed page by page.
+    """
+    from kubernetes import client
+
+    # Create Kubernetes API client on the shared connection pool
+    api_instance = client.CustomObjectsApi(api_client or get_api_client())
+
+    if resource_cache_directory:
+        from cache import cached_records
+
+        # Download only the backups created or updated since the previous run
+        return cached_records(
+            "backups",
+            api_instance.list_cluster_custom_object,
+            backup_record,
+            BackupRecord,
+            "/apis/velero.io/v1/backups",
+            page_size=velero_page_size,
+            group="velero.io",
+            version="v1",
+            plural="backups",
+            **({"label_selector": velero_label_selector()} if VELERO_SCHEDULES else {}),
+        )
+
+    # Stream Velero backups page by page, filtered to the configured schedules
+    return (
+        backup_record(backup)
+        for backup in iter_list_raw(
+            api_instance.list_cluster_custom_object,
+            group="velero.io",
+            version="v1",
+            plural="backups",
+            page_size=velero_page_size,
+            label_selector=velero_label_selector(),
+        )
+    )
+
+
+class SubnetRecord:
+    __slots__ = ("subnet_id", "region", "vpc_id", "name", "total_ips", "free_ips", "enis")
+
+    def __init__(self, subnet_id, region, vpc_id, name, total_ips, free_ips, enis):
+        self.subnet_id = subnet_id
+        self.region = region
+        self.vpc_id = vpc_id
+        self.name = name
+        self.total_ips = total_ips
+        self.free_ips = free_ips
+        self.enis = enis
+
+
+# EC2 clients by region, created on first use by get_ec2_client()
+_ec2_clients = {}
+# Subnet scans by region: (expiry on the monotonic clock, list of SubnetRecord)
+_subnet_cache = {}
+_aws_lock = threading.Lock()
+
+
+# Function to get the EC2 client of a region
+def get_ec2_client(region):
+    """
+    Return the EC2 client of a region, creating it on first use. Clients are
+    thread-safe and keep their connections, so one per region is shared.
+    A client wrapped in a botocore `Stubber` can be put in `_ec2_clients`.
+    """
+    with _aws_lock:
+        if region not in _ec2_clients:
+            import boto3
+
+            _ec2_clients[region] = boto3.session.Session().client("ec2", region_name=region)
+        return _ec2_clients[region]
+
+
+# Function to scan the subnets and network interfaces of one region
+def scan_region_subnets(region):
+    """
+    List every subnet of a region with one paginated scan of its subnets and
+    one paginated scan of its network interfaces, grouped by subnet here
+    instead of one describe_network_interfaces call per subnet.
+    Args:
+      region: The AWS region to scan.
+    Returns:
+      A (subnets, api_calls, api_time) tuple, subnets being a list of `SubnetRecord`.
+    """
+    ec2 = get_ec2_client(region)
+    api_calls = 0
+    api_time = 0.0
+
+    def pages(operation, **kwargs):
+        nonlocal api_calls, api_time
+        started = time.perf_counter()
+        for page in ec2.get_paginator(operation).paginate(**kwargs):
+            api_calls += 1
+            api_time += time.perf_counter() - started
+            yield page
+            started = time.perf_counter()
+
+    # Count the network interfaces of each subnet
+    enis = {}
+    for page in pages("describe_network_interfaces", PaginationConfig={"PageSize": 1000}):
+        for interface in page["NetworkInterfaces"]:
+            subnet_id = interface.get("SubnetId")
+            enis[subnet_id] = enis.get(subnet_id, 0) + 1
+
+    subnets = []
+    for page in pages("describe_subnets", PaginationConfig={"PageSize": 1000}):
+        for subnet in page["Subnets"]:
+            name = next(
+                (tag["Value"] for tag in subnet.get("Tags", []) if tag["Key"] == "Name"),
+                "-",
+            )
+            prefix_length = int(subnet["CidrBlock"].split("/")[1])
+            # AWS reserves five addresses in every subnet
+            total_ips = 2 ** (32 - prefix_length) - 5
+            subnets.append(
+                SubnetRecord(
+                    subnet["SubnetId"],
+                    region,
+                    subnet["VpcId"],
+                    name,
+                    total_ips,
+                    subnet["AvailableIpAddressCount"],
+                    enis.get(subnet["SubnetId"], 0),
+                )
+            )
+    return subnets, api_calls, api_time
+
+
+# Function to list the subnets of the configured AWS regions
+def fetch_subnets(api_client=None):
+    """
+    Scan the subnets of every region in `AWS_REGIONS` concurrently, reusing
+    the scan of a region for `subnet_cache_ttl` seconds.
+    Args:
+      api_client: Unused, subnets are read from the AWS API.
+    Returns:
+      A list of `SubnetRecord` instances, or None when the cloud provider is not AWS.
+    """
+    if cloud_provider != "aws":
+        return None
+    regions = AWS_REGIONS
+    if not regions:
+        import boto3
+
+        # Get the region from the IAM role
+        region = boto3.session.Session().region_name
+        if not region:
+            raise ValueError("Failed to retrieve AWS region from IAM role.")
+        regions = [region]
+
+    now = time.monotonic()
+    with _aws_lock:
+        cached = {
+            region: _subnet_cache[region][1]
+            for region in regions
+            if region in _subnet_cache and _subnet_cache[region][0] > now
+        }
+    stale = [region for region in regions if region not in cached]
+    if stale:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=len(stale)) as pool:
+            for region, (subnets, api_calls, api_time) in zip(
+                stale, pool.map(scan_region_subnets, stale)
+            ):
+                _count_perf(api_calls=api_calls, api_time=api_time, objects=len(subnets))
+                cached[region] = subnets
+        expires = time.monotonic() + subnet_cache_ttl
+        with _aws_lock:
+            for region in stale:
+                _subnet_cache[region] = (expires, cached[region])
+    return [subnet for region in regions for subnet in cached[region]]
+
+
+# Function to evaluate subnet IP capacity
+def evaluate_subnets(subnets):
+    """
+    Evaluate whether every subnet has at least `subnet_min_free_ips` free IP addresses.
+    Args:
+      subnets: A list of `SubnetRecord` instances, or None when the cloud
+        provider is not AWS.
+    Returns:
+      A ("PASSED", "FAILED" or "SKIPPED", subnet_table_output) tuple.
+    """
+    if subnets is None:
+        print_color("Cloud provider is not AWS. Skipping the subnet check.", NC)
+        return "SKIPPED", []
+    header = ["Subnet ID", "Region", "VPC", "Name", "ENIs", "Total IPs", "Used IPs", "Free IPs", "Status"]
+    rows = []
+    low_subnets = []
+    for subnet in sorted(subnets, key=lambda s: (s.region, s.vpc_id, s.name, s.subnet_id)):
+        status = "Low" if subnet.free_ips < subnet_min_free_ips else "OK"
+        if status == "Low":
+            low_subnets.append(f"{subnet.name} ({subnet.subnet_id})")
+        rows.append(
+            [
+                subnet.subnet_id,
+                subnet.region,
+                subnet.vpc_id,
+                subnet.name,
+                str(subnet.enis),
+                str(subnet.total_ips),
+                str(subnet.total_ips - subnet.free_ips),
+                str(subnet.free_ips),
+                status,
+            ]
+        )
+    widths = [max(len(cell) for cell in column) for column in zip(header, *rows)]
+    subnet_table_output = [
+        [cell.ljust(width) for cell, width in zip(row, widths)] for row in [header, *rows]
+    ]
+    if low_subnets:
+        print_color(
+            f"Some subnets have fewer than {subnet_min_free_ips} free IP addresses: {', '.join(low_subnets)}",
+            RED,
+        )
+        return "FAILED", subnet_table_output
+    print_color("All subnets have enough free IP addresses.", GREEN)
+    return "PASSED", subnet_table_output
+
+
+# Multipliers of Kubernetes quantity suffixes, two-letter suffixes first
+QUANTITY_SUFFIXES = {
+    "Ki": 2**10,
+    "Mi": 2**20,
+    "Gi": 2**30,
+    "Ti": 2**40,
+    "Pi": 2**50,
+    "Ei": 2**60,
+    "n": 1e-9,
+    "u": 1e-6,
+    "m": 1e-3,
+    "k": 1e3,
+    "M": 1e6,
+    "G": 1e9,
+    "T": 1e12,
+    "P": 1e15,
+    "E": 1e18,
+}
+
+
+# Function to parse Kubernetes quantity strings into a NumPy array
+def parse_quantities(quantities):
+    """
+    Parse quantity strings such as "250m", "1.5", "12345678n" or "512Mi"
+    with one vectorized pass per suffix instead of one parse per value.
+    Args:
+      quantities: A sequence of quantity strings, "" counts as 0.
+    Returns:
+      A float64 NumPy array of the values in base units (cores, bytes).
+    """
+    import numpy as np
+
+    quantities = np.asarray(quantities, dtype=str)
+    if quantities.size == 0:
+        return np.zeros(0)
+    quantities = np.where(quantities == "", "0", quantities)
+    multipliers = np.ones(quantities.shape)
+    matched = np.zeros(quantities.shape, dtype=bool)
+    for suffix, multiplier in QUANTITY_SUFFIXES.items():
+        suffixed = ~matched & np.char.endswith(quantities, suffix)
+        multipliers[suffixed] = multiplier
+        matched |= suffixed
+    numbers = np.char.rstrip(quantities, "".join(dict.fromkeys("".join(QUANTITY_SUFFIXES))))
+    return numbers.astype(np.float64) * multipliers
+
+
+# Function to sum per-container quantities into one value per object
+def sum_per_object(per_object_quantities):
+    """
+    Args:
+      per_object_quantities: A sequence holding, per object, a tuple of quantity strings.
+    Returns:
+      A float64 NumPy array with the sum of each object's quantities.
+    """
+    import numpy as np
+
+    counts = np.fromiter((len(q) for q in per_object_quantities), dtype=np.int64)
+    values = parse_quantities(list(chain.from_iterable(per_object_quantities)))
+    owners = np.repeat(np.arange(len(counts)), counts)
+    return np.bincount(owners, weights=values, minlength=len(counts))
+
+
+# Function to sum the requests of running pods per namespace
+def namespace_requests(pods, page_size=pod_page_size):
+    """
+    Args:
+      pods: An iterable of `PodRecord` instances. It is consumed once, a page
+        at a time, so a stream of pods is never held in memory.
+      page_size: Number of pods parsed per vectorized pass.
+    Returns:
+      A (namespaces, cpu, memory) tuple: a NumPy array of the namespaces with
+      running pods, and float64 arrays of the CPU cores and memory bytes
+      their running pods request.
+    """
+    import numpy as np
+
+    # namespace -> [requested cores, requested bytes]
+    totals = {}
+
+    def add(page):
+        page_namespaces, inverse = np.unique(
+            np.array([pod.namespace for pod in page], dtype=str), return_inverse=True
+        )
+        cpu = np.bincount(inverse, weights=sum_per_object([pod.cpu_requests for pod in page]))
+        memory = np.bincount(inverse, weights=sum_per_object([pod.memory_requests for pod in page]))
+        for namespace, namespace_cpu, namespace_memory in zip(page_namespaces, cpu, memory):
+            namespace_totals = totals.setdefault(str(namespace), [0.0, 0.0])
+            namespace_totals[0] += namespace_cpu
+            namespace_totals[1] += namespace_memory
+
+    page = []
+    for pod in pods:
+        if pod.phase != "Running":
+            continue
+        page.append(pod)
+        if len(page) >= page_size:
+            add(page)
+            page = []
+    if page:
+        add(page)
+    return (
+        np.array(list(totals), dtype=str),
+        np.array([cpu for cpu, _ in totals.values()], dtype=np.float64),
+        np.array([memory for _, memory in totals.values()], dtype=np.float64),
+    )
+
+
+# Function to list node usage from metrics.k8s.io
+def fetch_node_metrics(api_client=None):
+    """
+    Args:
+      api_client: The `ApiClient` of the cluster to check, defaults to the shared one.
+    Returns:
+      A dict of columns: "name", "cpu" and "memory", the last two holding
+      quantity strings.
+    """
+    from kubernetes import client
+
+    api = client.CustomObjectsApi(api_client or get_api_client())
+    columns = {"name": [], "cpu": [], "memory": []}
+    for item in iter_list_raw(
+        api.list_cluster_custom_object, group="metrics.k8s.io", version="v1beta1", plural="nodes"
+    ):
+        columns["name"].append(item["metadata"]["name"])
+        columns["cpu"].append(item["usage"]["cpu"])
+        columns["memory"].append(item["usage"]["memory"])
+    return columns
+
+
+# Function to list pod usage from metrics.k8s.io
+def fetch_pod_metrics(api_client=None):
+    """
+    Args:
+      api_client: The `ApiClient` of the cluster to check, defaults to the shared one.
+    Returns:
+      A dict of columns: "namespace", "name", "cpu" and "memory", the last
+      two holding a tuple of quantity strings per pod, one per container.
+      Only pods of the namespaces selected by the pod check are kept.
+    """
+    from kubernetes import client
+
+    api = client.CustomObjectsApi(api_client or get_api_client())
+    namespaces = select_namespaces(client.CoreV1Api(api_client or get_api_client()))
+    wanted = set(namespaces) if namespaces is not None else None
+    columns = {"namespace": [], "name": [], "cpu": [], "memory": []}
+    for item in iter_list_raw(
+        api.list_cluster_custom_object, group="metrics.k8s.io", version="v1beta1", plural="pods"
+    ):
+        namespace = item["metadata"]["namespace"]
+        if (wanted is not None and namespace not in wanted) or namespace in EXCLUDE_NAMESPACES:
+            continue
+        columns["namespace"].append(namespace)
+        columns["name"].append(item["metadata"]["name"])
+        columns["cpu"].append(tuple(c["usage"]["cpu"] for c in item["containers"]))
+        columns["memory"].append(tuple(c["usage"]["memory"] for c in item["containers"]))
+    return columns
+
+
+# Function to evaluate node and namespace resource usage
+def evaluate_resource_usage(nodes, pods, node_metrics, pod_metrics):
     """
-    Check the status of pods in the specified namespaces.
+    Compare CPU and memory usage with node allocatable and pod requests.
+    All parsing and aggregation is done on NumPy arrays: usage per node
+    against allocatable, usage per namespace against the requests of its
+    running pods, percentiles of node usage and the top pods by usage.
+    Args:
+      nodes: A list of `NodeRecord` instances.
+      pods: An iterable of `PodRecord` instances, consumed once.
+      node_metrics: The columns returned by `fetch_node_metrics`.
+      pod_metrics: The columns returned by `fetch_pod_metrics`.
     Returns:
-        True if all pods in the specified namespaces are ready (including "Completed" and "Succeeded"),
-        False if one or more pods are not ready, and a list of pods that are not ready.
+      A ("PASSED" or "FAILED", usage_table_output) tuple. The check fails
+      when a node uses `resource_usage_threshold` percent or more of its
+      allocatable CPU or memory.
     """
-    # Initialize a list to collect pod information
-    pod_info = []
-    problematic_pods = []  # To store problematic pods
-    print_color("# Checking Pods Status #", NC)
-    all_pods_running = True  # Track if all pods are running in all namespaces
-
-    try:
-        # Load Kubernetes configuration from service account
-        config.load_incluster_config()
-
-        # Initialize Kubernetes API client
-        api = client.CoreV1Api()
-
-        # Iterate through namespaces and collect pod info
-        for namespace in NAMESPACES:
-            if namespace != "":
-                pods = api.list_namespaced_pod(namespace).items
-                for pod in pods:
-                    pod_name = pod.metadata.name
-                    pod_status = pod.status.phase
-                    pod_info.append((namespace, pod_name, pod_status))
-                    if pod_status not in ["Running", "Completed", "Succeeded"]:
-                        all_pods_running = (
-                            False  # Set to False if any pod is not running
-                        )
-                        problematic_pods.append((namespace, pod_name))
-
-        # Calculate the appropriate column widths with a minimum width of 10 for the Status column
-        max_namespace_width = max(len(namespace) for namespace, _, _ in pod_info)
-        max_pod_width = max(len(pod_name) for _, pod_name, _ in pod_info)
-        max_status_width = max(
-            max(len(pod_status), 10) for _, _, pod_status in pod_info
+    import numpy as np
+
+    def percent(used, available):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(available > 0, used / available * 100, np.nan)
+
+    def cores(value):
+        return f"{value:.2f}"
+
+    def mebibytes(value):
+        return f"{value / 2**20:.0f}Mi"
+
+    def pct(value):
+        return "-" if np.isnan(value) else f"{value:.1f}%"
+
+    rows = []
+    # Node usage against allocatable, matched by name with a sorted search
+    node_names = np.array([node.name for node in nodes], dtype=str)
+    order = np.argsort(node_names)
+    sorted_names = node_names[order]
+    metric_names = np.asarray(node_metrics["name"], dtype=str)
+    positions = np.searchsorted(sorted_names, metric_names)
+    known = positions < len(sorted_names)
+    known[known] = sorted_names[positions[known]] == metric_names[known]
+    node_index = order[positions[known]]
+    metric_names = metric_names[known]
+    node_cpu = parse_quantities(node_metrics["cpu"])[known]
+    node_memory = parse_quantities(node_metrics["memory"])[known]
+    node_cpu_pct = percent(node_cpu, parse_quantities([n.allocatable_cpu for n in nodes])[node_index])
+    node_memory_pct = percent(
+        node_memory, parse_quantities([n.allocatable_memory for n in nodes])[node_index]
+    )
+    node_high = np.fmax(node_cpu_pct, node_memory_pct) >= resource_usage_threshold
+    for i in np.argsort(metric_names):
+        rows.append(
+            [
+                "Node",
+                metric_names[i],
+                cores(node_cpu[i]),
+                pct(node_cpu_pct[i]),
+                mebibytes(node_memory[i]),
+                pct(node_memory_pct[i]),
+                "High" if node_high[i] else "OK",
+            ]
+        )
+    if metric_names.size:
+        import warnings
+
+        with warnings.catch_warnings():
+            # Nodes without allocatable only yield NaN percentiles
+            warnings.simplefilter("ignore", RuntimeWarning)
+            cpu_percentiles = np.nanpercentile(node_cpu_pct, (50, 90, 99))
+            memory_percentiles = np.nanpercentile(node_memory_pct, (50, 90, 99))
+        for q, cpu_q, memory_q in zip((50, 90, 99), cpu_percentiles, memory_percentiles):
+            rows.append([f"Nodes p{q}", "-", "-", pct(cpu_q), "-", pct(memory_q), "-"])
+
+    # Namespace usage against the requests of running pods
+    request_namespaces, request_cpu, request_memory = namespace_requests(pods)
+    usage_namespaces = np.asarray(pod_metrics["namespace"], dtype=str)
+    namespaces, inverse = np.unique(
+        np.concatenate([request_namespaces, usage_namespaces]), return_inverse=True
+    )
+    request_index = inverse[: len(request_namespaces)]
+    usage_index = inverse[len(request_namespaces) :]
+    pod_cpu = sum_per_object(pod_metrics["cpu"])
+    pod_memory = sum_per_object(pod_metrics["memory"])
+    totals = [
+        np.bincount(index, weights=values, minlength=len(namespaces))
+        for index, values in (
+            (usage_index, pod_cpu),
+            (request_index, request_cpu),
+            (usage_index, pod_memory),
+            (request_index, request_memory),
         )
-        # Create a list to store the rows of the table
-        pod_table_output = []
-        # Print the table header
-        pod_table_output.append(
+    ]
+    namespace_cpu_pct = percent(totals[0], totals[1])
+    namespace_memory_pct = percent(totals[2], totals[3])
+    over_requests = np.fmax(namespace_cpu_pct, namespace_memory_pct) > 100
+    for i in range(len(namespaces)):
+        rows.append(
             [
-                "Namespace".ljust(max_namespace_width),
-                "Pod".ljust(max_pod_width),
-                "Status".ljust(max_status_width),
+                "Namespace",
+                namespaces[i],
+                cores(totals[0][i]),
+                pct(namespace_cpu_pct[i]),
+                mebibytes(totals[2][i]),
+                pct(namespace_memory_pct[i]),
+                "Over requests" if over_requests[i] else "OK",
             ]
         )
-        # Print pod info with proper formatting
-        for namespace, pod_name, pod_status in pod_info:
-            namespace_formatted = namespace.ljust(max_namespace_width)
-            pod_name_formatted = pod_name.ljust(max_pod_width)
-            pod_status_formatted = pod_status.ljust(max_status_width)
-            if pod_status in ["Running", "Completed", "Succeeded"]:
-                pod_table_output.append(
-                    [namespace_formatted, pod_name_formatted, pod_status_formatted]
-                )
-            else:
-                pod_table_output.append(
-                    [namespace_formatted, pod_name_formatted, pod_status_formatted]
-                )
 
-        if all_pods_running:
-            print_color("All pods are in Running state", GREEN)
-        else:
-            print_color("Some pods are not in Running state", RED)
-            print_color("Problematic Pods:", RED)
-            for namespace, pod_name in problematic_pods:
-                print_color(f"Namespace: {namespace}, Pod: {pod_name}", RED)
-            return "FAILED", pod_table_output
+    # Top pods by CPU and by memory
+    top = min(resource_top_pods, len(pod_cpu))
+    for label, values in (("Top pod (CPU)", pod_cpu), ("Top pod (memory)", pod_memory)):
+        if top <= 0:
+            break
+        largest = np.argpartition(-values, top - 1)[:top]
+        for i in largest[np.argsort(-values[largest])]:
+            rows.append(
+                [
+                    label,
+                    f"{pod_metrics['namespace'][i]}/{pod_metrics['name'][i]}",
+                    cores(pod_cpu[i]),
+                    "-",
+                    mebibytes(pod_memory[i]),
+                    "-",
+                    "-",
+                ]
+            )
 
-        return "PASSED", pod_table_output
-    except Exception as e:
-        print_color("Error while checking pod status:", RED)
-        print_color(str(e), RED)
+    if not rows:
+        print_color("No resource metrics found.", RED)
         return "FAILED", []
-
-# Function to check if Velero backup is present
-def check_velero_backup():
-    """Check if a Velero backup is present.
-
+    header = ["Scope", "Name", "CPU", "CPU %", "Memory", "Memory %", "Status"]
+    widths = [max(len(cell) for cell in column) for column in zip(header, *rows)]
+    usage_table_output = [
+        [cell.ljust(width) for cell, width in zip(row, widths)] for row in [header, *rows]
+    ]
+    if node_high.any():
+        print_color(
+            f"Some nodes use {resource_usage_threshold}% or more of their CPU or memory: "
+            f"{', '.join(metric_names[node_high])}",
+            RED,
+        )
+        return "FAILED", usage_table_output
+    print_color(f"All nodes use less than {resource_usage_threshold}% of their CPU and memory.", GREEN)
+    return "PASSED", usage_table_output
+
+
+# Resources checks can read, by name: functions taking an `api_client` and
+# returning the resource's records
+RESOURCES = {
+    "nodes": fetch_nodes,
+    "pods": fetch_pods,
+    "backups": fetch_backups,
+    "subnets": fetch_subnets,
+    "node_metrics": fetch_node_metrics,
+    "pod_metrics": fetch_pod_metrics,
+}
+
+# Resources too large to hold in memory: when several checks read one, its
+# records are handed to each of them page by page instead of being listed once
+STREAMED_RESOURCES = {"pods"}
+
+
+class Check:
+    """A registered health check and how its result is reported."""
+
+    __slots__ = (
+        "name",
+        "title",
+        "summary",
+        "resources",
+        "evaluate",
+        "timeout",
+        "table_type",
+        "key_columns",
+        "scope_column",
+        "description",
+    )
+
+    def __init__(
+        self,
+        name,
+        title,
+        summary,
+        resources,
+        evaluate,
+        timeout,
+        table_type,
+        key_columns,
+        scope_column,
+        description,
+    ):
+        self.name = name
+        self.title = title
+        self.summary = summary
+        self.resources = resources
+        self.evaluate = evaluate
+        self.timeout = timeout
+        self.table_type = table_type
+        self.key_columns = key_columns
+        self.scope_column = scope_column
+        self.description = description
+
+
+# Registered health checks by name
+CHECK_REGISTRY = {}
+
+
+# Function to register a health check
+def register_check(
+    name,
+    title,
+    summary,
+    resources,
+    evaluate,
+    timeout=None,
+    table_type=None,
+    key_columns=None,
+    scope_column=None,
+    description=None,
+):
+    """
+    Register a health check.
+    Args:
+      name: Short name of the check, used in results, metrics and `enabled_checks`.
+      title: Title of the check's report table, e.g. "Node Status".
+      summary: The summary row of the check, e.g. "All Nodes are in Ready state".
+      resources: Names of the `RESOURCES` the check reads. A resource read by
+        several running checks is fetched once and shared between them.
+      evaluate: Function taking the records of each resource, in order, and
+        returning a ("PASSED" or "FAILED", table_output) tuple.
+      timeout: Seconds the check may run, None falls back to check_timeout.
+      table_type: How the rows of the check's table are highlighted, see
+        `row_state`. Defaults to the check name.
+      key_columns: Number of leading table columns identifying an object, used
+        to diff runs. None leaves the check out of snapshots.
+      scope_column: Index of the table column naming the namespace, node
+        group or region a row belongs to, used to group the run history.
+      description: What the check verifies, shown in the report overview.
+        Defaults to the summary.
     Returns:
-        "PASSED" if a backup is present and in a completed state,
-        "FAILED" if no backup is present or if a backup is not in a completed state.
+      The registered `Check`.
     """
-    # Initialize a list to collect backup information
-    backup_info = []
-    incomplete_backups = []  # To store names of incomplete backups
-    print_color("# Checking Velero Backups #", NC)
+    unknown = [resource for resource in resources if resource not in RESOURCES]
+    if unknown:
+        raise ValueError(f"Check '{name}' reads unknown resources: {', '.join(unknown)}")
+    check = Check(
+        name,
+        title,
+        summary,
+        tuple(resources),
+        evaluate,
+        timeout,
+        table_type or name,
+        key_columns,
+        scope_column,
+        description or summary,
+    )
+    CHECK_REGISTRY[name] = check
+    return check
+
+
+register_check(
+    "nodes",
+    "Node Status",
+    "All Nodes are in Ready state",
+    ["nodes"],
+    evaluate_nodes,
+    key_columns=1,
+    scope_column=2,
+    description="Verifies that all nodes in the cluster are in a ready state, ensuring the foundation of cluster is stable.",
+)
+register_check(
+    "resource_usage",
+    "Resource Usage",
+    "Nodes have CPU and memory to spare",
+    ["nodes", "pods", "node_metrics", "pod_metrics"],
+    evaluate_resource_usage,
+    key_columns=2,
+    scope_column=0,
+    description="Compares the CPU and memory use of each node with its allocatable capacity and lists the pods using the most.",
+)
+register_check(
+    "node_versions",
+    "Node Versions",
+    "All Nodes run a supported version",
+    ["nodes"],
+    evaluate_node_versions,
+    key_columns=1,
+    description="Verifies that every node runs a kubelet version that is still supported.",
+)
+register_check(
+    "pods",
+    "Pods Status",
+    "All Pods are in Running state",
+    ["pods"],
+    evaluate_pods,
+    key_columns=2,
+    scope_column=0,
+    description="Assesses the running status of pods across different namespaces, ensuring all system pods are operating smoothly.",
+)
+register_check(
+    "backup",
+    "Velero Status",
+    "Velero backup is present",
+    ["backups"],
+    evaluate_backups,
+    key_columns=2,
+    scope_column=0,
+    description="Checks if Velero backups are present and completed, safeguarding your cluster's data and configurations.",
+)
 
-    try:
-        # Load kubeconfig from default location or service account
-        config.load_incluster_config()
 
-        # Create Kubernetes API client
-        api_instance = client.CustomObjectsApi()
+register_check(
+    "subnets",
+    "Subnet Capacity",
+    "Subnets have enough free IP addresses",
+    ["subnets"],
+    evaluate_subnets,
+    key_columns=1,
+    scope_column=1,
+    description="Verifies that the subnets in the account have enough free IP addresses available.",
+)
 
-        # Retrieve Velero backups
-        backups = api_instance.list_cluster_custom_object(
-            group="velero.io", version="v1", plural="backups"
-        )["items"]
 
-        # Check if no backups are found
-        if not backups:
-            print_color("No backups found.", RED)
-            return "FAILED", []
+# Function to resolve the checks selected by enabled_checks
+def enabled_checks(names=enabled_checks_str):
+    """
+    Args:
+      names: Comma-separated check names.
+    Returns:
+      The selected `Check` instances, in the given order.
+    """
+    checks = []
+    for name in names.split(","):
+        name = name.strip()
+        if not name:
+            continue
+        if name not in CHECK_REGISTRY:
+            raise ValueError(
+                f"Unknown check '{name}' in enabled_checks, use one of {', '.join(CHECK_REGISTRY)}."
+            )
+        checks.append(CHECK_REGISTRY[name])
+    return checks
 
-        # Sort backups by creation timestamp in descending order
-        backups.sort(key=lambda x: x["metadata"]["creationTimestamp"], reverse=True)
 
-        # Include only the last backup
-        for backup in backups[:1]:
-            backup_name = backup["metadata"]["name"]
-            backup_status = backup["status"]["phase"]
-            backup_info.append((backup_name, backup_status))
+# Health checks run by the concurrent runner, in report order
+CHECKS = enabled_checks()
 
-            if "Completed" not in backup_status:
-                incomplete_backups.append(backup_name)
 
-            # Calculate column widths based on the longest values
-            max_backup_name_width = max(
-                len(backup["metadata"]["name"]) for backup in backups
-            )
-            max_status_width = max(
-                max(len(backup_status), 10) for _, backup_status in backup_info
-            )
+# Function to run a callable on a daemon thread
+def _run_in_thread(name, func):
+    """
+    Run `func` on a daemon thread and return a future for its result.
+    Daemon threads are used so that a check stuck on the network cannot keep
+    the process alive after its timeout has expired.
+    """
+    future = Future()
+    # Keep the caller's output setting, so a quiet cluster run stays quiet
+    quiet = getattr(_output, "quiet", False)
 
-            # Create a list to store the rows of the table
-            backup_table_output = []
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
+        _output.quiet = quiet
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
 
-            # Print the table header with "Name" and "Status"
-            backup_table_output.append(
-                ["Name".ljust(max_backup_name_width), "Status".ljust(max_status_width)]
-            )
+    threading.Thread(target=target, name=f"check-{name}", daemon=True).start()
+    return future
 
-            # Print backup info with proper formatting
-            for backup_name, backup_status in backup_info:
-                name_formatted = backup_name.ljust(max_backup_name_width)
-                status_formatted = backup_status.ljust(max_status_width)
 
-                if "Completed" not in backup_status:
-                    backup_table_output.append([name_formatted, status_formatted])
+class SharedStream:
+    """
+    Hand the records of a single streamed fetch to several readers, a page
+    at a time, so that none of them needs the whole resource in memory.
+    Each reader has a queue of at most `depth` pages and the fetch waits
+    while one of them is full, so memory is bounded by the slowest reader.
+    A reader that stops early is detached and no longer holds up the others.
+    Args:
+      readers: The number of readers.
+      page_size: The number of records per page.
+      depth: The number of pages queued per reader.
+    """
+
+    def __init__(self, readers, page_size=pod_page_size, depth=2):
+        self.queues = [queue.Queue(maxsize=depth) for _ in range(readers)]
+        self.detached = [False] * readers
+        self.page_size = page_size
+        self.next_reader = 0
+        self.lock = threading.Lock()
+
+    def _put(self, item):
+        for index, pages in enumerate(self.queues):
+            while not self.detached[index]:
+                try:
+                    pages.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    def feed(self, records):
+        """Fan the records out to every reader, then end their streams."""
+        try:
+            page = []
+            for record in records:
+                page.append(record)
+                if len(page) >= self.page_size:
+                    if all(self.detached):
+                        return
+                    self._put(page)
+                    page = []
+            if page:
+                self._put(page)
+            self._put(None)
+        except Exception as e:
+            # Every reader fails with the error of the fetch
+            self._put(e)
+            raise
+
+    def reader(self):
+        """Return the next reader, to be iterated once and closed when done."""
+        with self.lock:
+            index = self.next_reader
+            self.next_reader += 1
+        return SharedStreamReader(self, index)
+
+
+class SharedStreamReader:
+    """One reader of a `SharedStream`."""
+
+    def __init__(self, stream, index):
+        self.stream = stream
+        self.index = index
+
+    def __iter__(self):
+        pages = self.stream.queues[self.index]
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield from page
+        finally:
+            self.close()
+
+    def close(self):
+        self.stream.detached[self.index] = True
+
+
+# Function to fetch a resource shared by several checks
+def _fetch_shared(stage, resource, api_client, stream=None):
+    with perf_stage(stage):
+        if stream is not None:
+            return stream.feed(RESOURCES[resource](api_client))
+        return list(RESOURCES[resource](api_client))
+
+
+# Function to run a single check as its own measured stage
+def _run_check(stage, check, api_client, shared):
+    with perf_stage(stage):
+        print_color(f"# Checking {check.title} #", NC)
+        try:
+            # Shared resources come from their single fetch, the others are streamed
+            inputs = []
+            for resource in check.resources:
+                if resource not in shared:
+                    inputs.append(RESOURCES[resource](api_client))
+                elif isinstance(shared[resource], SharedStream):
+                    inputs.append(shared[resource].reader())
                 else:
-                    backup_table_output.append([name_formatted, status_formatted])
+                    inputs.append(shared[resource].result())
+            return check.evaluate(*inputs)
+        except Exception as e:
+            print_color(f"Error while checking {check.title}:", RED)
+            print_color(str(e), RED)
+            return "FAILED", []
+        finally:
+            # Let shared streams go on without a check that stopped reading
+            for value in inputs:
+                if isinstance(value, SharedStreamReader):
+                    value.close()
 
-            # Check if any backup is not in a completed state and return result accordingly
-            if incomplete_backups:
-                print_color("Some backups are not in a completed state:", RED)
-                for backup_name in incomplete_backups:
-                    print_color(f"Backup Name: {backup_name}", RED)
-                return "FAILED", backup_table_output
 
-            print_color("All backups are in a completed state", GREEN)
-            return "PASSED", backup_table_output
+# Function to run the health checks concurrently
+def run_checks(checks, api_client=None, cluster=None):
+    """
+    Run all checks in parallel, each bounded by its own timeout.
+    A resource read by more than one check is fetched once, on its own
+    thread, and shared between them: listed once, or for
+    `STREAMED_RESOURCES` handed to each check page by page. A resource read
+    by a single check is streamed straight into it.
+    Args:
+      checks: List of registered `Check` instances.
+      api_client: The `ApiClient` of the cluster to check, defaults to the shared one.
+      cluster: The cluster name, used to prefix the performance stages when
+        several clusters are checked in one run.
+    Returns:
+      A dict mapping each check name to its (status, table_output) result.
+      Checks that time out or raise are reported as ("FAILED", []).
+    """
+    started = time.monotonic()
+    prefix = f"{cluster}/" if cluster else ""
+    readers = {}
+    for check in checks:
+        for resource in check.resources:
+            readers[resource] = readers.get(resource, 0) + 1
+    shared = {}
+    for resource, reader_count in readers.items():
+        if reader_count < 2:
+            continue
+        stream = SharedStream(reader_count) if resource in STREAMED_RESOURCES else None
+        future = _run_in_thread(
+            f"fetch-{resource}",
+            partial(_fetch_shared, f"{prefix}fetch_{resource}", resource, api_client, stream),
+        )
+        shared[resource] = stream or future
+    futures = [
+        (
+            check.name,
+            _run_in_thread(
+                check.name,
+                partial(_run_check, f"{prefix}{check.name}", check, api_client, shared),
+            ),
+            check.timeout or check_timeout,
+        )
+        for check in checks
+    ]
+    results = {}
+    for name, future, timeout in futures:
+        remaining = max(started + timeout - time.monotonic(), 0)
+        try:
+            results[name] = future.result(timeout=remaining)
+        except FutureTimeoutError:
+            print_color(f"Check '{name}' timed out after {timeout} seconds", RED)
+            results[name] = ("FAILED", [])
+        except Exception as e:
+            print_color(f"Error while running check '{name}':", RED)
+            print_color(str(e), RED)
+            results[name] = ("FAILED", [])
+    return results
+
+
+# Function to run all checks against one kubeconfig context
+def check_cluster(context):
+    """
+    Run all checks against one cluster with its own `ApiClient`.
+    Output of the individual checks is silenced, so that the logs of
+    clusters checked at the same time do not interleave; a one-line status
+    is printed instead.
+    Args:
+      context: The kubeconfig context of the cluster.
+    Returns:
+      A dict mapping each check name to its (status, table_output) result.
+      When the cluster cannot be reached every check is reported as ("FAILED", []).
+    """
+    try:
+        api_client = build_api_client(context)
     except Exception as e:
-        print_color("Error while checking Velero backup status:", RED)
-        print_color(str(e), RED)
-        return "FAILED", []
+        print_color(f"Error while connecting to cluster '{context}': {str(e)}", RED)
+        return {check.name: ("FAILED", []) for check in CHECKS}
+    try:
+        results = run_quietly(run_checks, CHECKS, api_client, cluster=context)
+    finally:
+        api_client.close()
+    statuses = ", ".join(f"{name}: {status}" for name, (status, _) in results.items())
+    failed = any(status == "FAILED" for status, _ in results.values())
+    print_color(f"Cluster {context}: {statuses}", RED if failed else GREEN)
+    return results
+
+
+# Function to check several clusters concurrently
+def run_clusters(contexts, workers=cluster_workers):
+    """
+    Fan the checks out over a pool of workers, one cluster per worker.
+    Args:
+      contexts: List of kubeconfig contexts to check.
+      workers: Maximum number of clusters checked at the same time.
+    Returns:
+      A dict mapping each context, in the given order, to its check results.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(contexts)))) as pool:
+        futures = {pool.submit(check_cluster, context): context for context in contexts}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return {context: results[context] for context in contexts}
+
 
 # Health check summary data
 # Function to generate summary
 summary_data = []
 
-def generate_summary(node_status, pods_status, backup_status):
+def generate_summary(results):
     """
-    Generate a healthcheck summary based on the results of the `check_nodes_ready()`,
-    `check_pods_ready()`, and `check_backup_present()` functions.
+    Generate a healthcheck summary with one row per check, based on the
+    results of `run_checks`.
     Args:
-      node_status: The status of the nodes, either "PASSED" or "FAILED".
-      pods_status: The status of the pods, either "PASSED" or "FAILED".
-      backup_status: The status of the Velero backup, either "PASSED" or "FAILED".
+      results: A dict mapping each check name to its (status, table_output) result.
     Returns:
-      None.
+      None.
     """
     print_color("# Healthcheck Summary #", NC)
     # lear the summary data
@@ -388,33 +2385,147 @@ def generate_summary(node_status, pods_status, backup_status):
         print_color(f"{title}: {status}", GREEN if status == "PASSED" else RED)
 
     add_summary_item("Check", "Status")
-    add_summary_item("All Nodes are in Ready state", node_status)
-    add_summary_item("All Pods are in Running state", pods_status)
-    add_summary_item("Velero backup is present", backup_status)
+    for check in CHECKS:
+        add_summary_item(check.summary, results[check.name][0])
+
+
+# Function to compare a kubelet version with the minimum version, once per distinct version
+@lru_cache(maxsize=None)
+def version_below_minimum(version):
+    """
+    Args:
+      version: A "major.minor" version string, or "N/A" when it is unknown.
+    Returns:
+      True if the version is known and below `minimum_eks_version`.
+    """
+    try:
+        return float(version) < minimum_eks_version
+    except ValueError:
+        return False
+
+
+# Function to classify a report table row for highlighting
+def row_state(table_type, row):
+    """
+    Classify a data row of a report table.
+    Args:
+      table_type: The type of table the row belongs to.
+      row: The row, with the status in the last column.
+    Returns:
+      "ok", "warning" or "failed", or None for tables without highlighting.
+    """
+    row_status = row[-1]  # Assuming the status is in the last column of the row
+    # Apply different row conditions based on the table type
+    if table_type == "summary":
+        if "FAILED" in row_status:
+            return "failed"
+        return "warning" if "SKIPPED" in row_status else "ok"
+    if table_type == "nodes":
+        if row_status.strip() != "Ready":
+            return "failed"
+        # Check if the version, or any version of a node group, is below the minimum version
+        below = any(version_below_minimum(version.strip()) for version in row[1].split(","))
+        return "warning" if below else "ok"
+    if table_type == "pods":
+        return "ok" if "Running" in row_status or "Succeeded" in row_status else "failed"
+    if table_type == "backup":
+        return "ok" if "Completed" in row_status else "failed"
+    if table_type == "node_versions":
+        return "failed" if "Outdated" in row_status else "ok"
+    if table_type == "subnets":
+        return "failed" if "Low" in row_status else "ok"
+    if table_type == "resource_usage":
+        if "High" in row_status:
+            return "failed"
+        return "warning" if "Over requests" in row_status else "ok"
+    if table_type == "changes":
+        if row_status == "Recovered":
+            return "ok"
+        return "warning" if row_status == "Version drift" else "failed"
+    return None
+
+
+# Function to run-length encode row highlighting into table style commands
+def row_background_commands(table_type, rows, state_colors, default_state):
+    """
+    Build one BACKGROUND command per run of contiguous rows in the same
+    state, skipping runs in the default state that the table already has,
+    so the number of commands grows with status changes, not with rows.
+    Args:
+      table_type: The type of table the rows belong to.
+      rows: The data rows, the first one is drawn as table row 1.
+      state_colors: A dict mapping each row state to its background color.
+      default_state: The state already applied to all data rows.
+    Returns:
+      A list of reportlab table style commands.
+    """
+    commands = []
+    run_state, run_start = default_state, 1
+    for i, row in enumerate(rows, start=1):
+        state = row_state(table_type, row)
+        if state != run_state:
+            if run_state != default_state:
+                commands.append(
+                    ("BACKGROUND", (0, run_start), (-1, i - 1), state_colors[run_state])
+                )
+            run_state, run_start = state, i
+    if run_state != default_state:
+        commands.append(
+            ("BACKGROUND", (0, run_start), (-1, len(rows)), state_colors[run_state])
+        )
+    return commands
 
 
 # Function to generate pdf
 def generate_result_table(title, data, elements, table_type, header_color="#337AB7"):
     """
     Generate a table with the results of a specific health check.
+    The rows are split into tables of `pdf_table_rows` rows, each repeating
+    the header, so reportlab lays out one page-sized table at a time instead
+    of splitting one huge table over and over. Column widths are measured
+    once for the whole table and passed to reportlab, and row highlighting
+    is applied as one style command per run of rows in the same state.
     Args:
-      title: The title of the table.
-      data: The data to be displayed in the table.
-      elements: The list of report elements to which the table will be added.
-      header_color: The color for the table header.
+      title: The title of the table.
+      data: The data to be displayed in the table.
+      elements: The list of report elements to which the table will be added.
+      header_color: The color for the table header.
 
     Returns:
-      None.
+      None.
     """
     if not data:
         return
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_LEFT
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    from reportlab.platypus import Paragraph, Spacer, Table, TableStyle
+
+    state_colors = {
+        None: colors.beige,
+        "ok": colors.white,
+        "warning": colors.yellow,
+        "failed": colors.red,
+    }
     try:
-        # Calculate column widths based on the maximum content length for each column
+        header, rows = data[0], data[1:]
+        # Measure the widest cell of each column once, in the fonts the table uses
+        widest_cells = [str(cell) for cell in header]
+        for row in rows:
+            for i, cell in enumerate(row):
+                cell = str(cell)
+                if len(cell) > len(widest_cells[i]):
+                    widest_cells[i] = cell
         col_widths = [
-            max(len(str(row[i])) for row in data) for i in range(len(data[0]))
+            max(stringWidth(str(label), "Courier-Bold", 10), stringWidth(cell, "Helvetica", 10))
+            + 12  # Left and right cell padding
+            for label, cell in zip(header, widest_cells)
         ]
-        # Create a table style with specific settings
-        table_style = [
+        # Rows of typed tables are white unless they need attention, others stay beige
+        default_state = "ok" if table_type != "performance" else None
+        # Create a table style with specific settings, shared by every chunk
+        base_style = [
             (
                 "BACKGROUND",
                 (0, 0),
@@ -429,105 +2540,99 @@ def generate_result_table(title, data, elements, table_type, header_color="#337A
                 "BACKGROUND",
                 (0, 1),
                 (-1, -1),
-                colors.beige,
+                state_colors[default_state],
             ),  # Background color for content rows
             ("GRID", (0, 0), (-1, -1), 1, colors.black),  # Add grid lines
         ]
-        # Loop through the data rows and apply cell background color based on table type
-        for i in range(1, len(data)):
-            row = data[i]  # Get the row data
-            row_status = row[-1]  # Assuming the status is in the last column of the row
-            # Apply different row coloring conditions based on the table type
-            if table_type == "summary":
-                if "FAILED" in row_status:
-                    table_style.extend([("BACKGROUND", (0, i), (-1, i), colors.red)])
-                else:
-                    table_style.extend([("BACKGROUND", (0, i), (-1, i), colors.white)])
-            elif table_type == "nodes":
-                row_version = row[-2]
-                # Customize row coloring conditions for the "nodes" table
-                if "Ready" in row_status:
-                    # Check if the version is below 1.25
-                    if float(row_version) < minimum_eks_version:
-                        table_style.extend(
-                            [("BACKGROUND", (0, i), (-1, i), colors.yellow)]
-                        )
-                    else:
-                        table_style.extend(
-                            [("BACKGROUND", (0, i), (-1, i), colors.white)]
-                        )
-                else:
-                    table_style.extend([("BACKGROUND", (0, i), (-1, i), colors.red)])
-            elif table_type == "pods":
-                # Customize row coloring conditions for the "pods" table
-                if "Running" in row_status:
-                    table_style.extend([("BACKGROUND", (0, i), (-1, i), colors.white)])
-                elif "Succeeded" in row_status:
-                    table_style.extend([("BACKGROUND", (0, i), (-1, i), colors.white)])
-                else:
-                    table_style.extend([("BACKGROUND", (0, i), (-1, i), colors.red)])
-
-            elif table_type == "backup":
-                # Customize row coloring conditions for the "pods" table
-                if "Completed" not in row_status:
-                    table_style.extend([("BACKGROUND", (0, i), (-1, i), colors.red)])
-                else:
-                    table_style.extend([("BACKGROUND", (0, i), (-1, i), colors.white)])
-        # Set column widths for the header row and data rows
-        table_style.extend(
-            [
-                ("COLWIDTH", (i, 0), (i, -1), col_widths[i])
-                for i in range(len(col_widths))
-            ]
-        )
-        # Create the table and apply the style
-        table = Table(data, repeatRows=1)
-        table.setStyle(TableStyle(table_style))
 
         # Create a title paragraph
         title_style = getSampleStyleSheet()["Heading2"]
         title_style.alignment = TA_LEFT  # Left-align the title
-        title_paragraph = Paragraph(title, title_style)
-
-        # Add the title and table to the elements
-        elements.append(title_paragraph)
-        elements.append(table)
+        elements.append(Paragraph(title, title_style))
+
+        chunk_rows = max(pdf_table_rows, 1)
+        for start in range(0, max(len(rows), 1), chunk_rows):
+            chunk = rows[start : start + chunk_rows]
+            # Highlight the rows that are not in the default state
+            table_style = base_style + row_background_commands(
+                table_type, chunk, state_colors, default_state
+            )
+            # Create the table and apply the style
+            table = Table([header] + chunk, colWidths=col_widths, repeatRows=1)
+            table.setStyle(TableStyle(table_style))
+            elements.append(table)
         elements.append(Spacer(1, 12))  # Add space after the table
     except Exception as e:
         print_color(f"Error while generating result table: {str(e)}", RED)
 
 
-def send_email(
-    recipients, cluster_name, pdf_file_path, node_status, pods_status, backup_status
-):
+# Function to build the performance breakdown table
+def performance_table():
+    """
+    Build a "Performance" table with the counters recorded so far in this run.
+    Stages that finish after the report is written, such as "pdf_build" and
+    "smtp_send", only appear in the JSON output of `emit_perf_stats`.
+    Returns:
+      The table rows, starting with the header.
+    """
+    perf_table = [
+        [
+            "Stage",
+            "Wall time (s)",
+            "API calls",
+            "API time (s)",
+            "Decode time (s)",
+            "Bytes received",
+            "Objects",
+            "Throttled",
+        ]
+    ]
+    for name, stats in get_perf_stats().items():
+        perf_table.append(
+            [
+                name,
+                stats["wall_time"],
+                stats["api_calls"],
+                stats["api_time"],
+                stats["decode_time"],
+                stats["bytes_received"],
+                stats["objects"],
+                stats["throttled"],
+            ]
+        )
+    return perf_table
+
+
+def send_email(recipients, cluster_name, report_path, statuses):
     """
-    Send an email with the health check report as an attachment and include the health check summary.
+    Queue an email with the health check report as an attachment and include the health check summary.
+    The email is sent by the background delivery thread of `mailer`, over a
+    reused SMTP connection, with retries.
     Args:
         recipients: List of email recipients.
         cluster_name: Name of the cluster.
-        pdf_file_path: Path to the PDF file to be attached.
-        node_status: The status of the nodes, either "PASSED" or "FAILED".
-        pods_status: The status of the pods, either "PASSED" or "FAILED".
-        backup_status: The status of the Velero backup, either "PASSED" or "FAILED".
+        report_path: Path to the report file to be attached.
+        statuses: A dict mapping each check name to "PASSED", "FAILED" or "SKIPPED".
     Returns:
-        None.
+        A `Future` resolved once the email has been sent.
     """
-    # Email configuration
-    sender_email = os.environ.get("SENDER_EMAIL")
-    sender_password = os.environ.get("SENDER_PASSWORD")
-    smtp_server = os.environ.get("SMTP_SERVER")
-    smtp_port = int(os.environ.get("SMTP_PORT", 587))
+    import mailer
 
-    if not all([sender_email, sender_password, smtp_server]):
+    # SENDER_PASSWORD may be left empty for relays that do not authenticate
+    if not all([mailer.sender_email, mailer.smtp_server]):
         raise ValueError(
             "Email configuration missing. Make sure to set SENDER_EMAIL, SENDER_PASSWORD, and SMTP_SERVER in the environment."
         )
     subject = f"EKS Cluster Health Report for {cluster_name}"
-    # Create a multipart message
-    msg = MIMEMultipart()
-    msg["From"] = sender_email
-    msg["To"] = ", ".join(recipients)
-    msg["Subject"] = subject
+    # One summary row per registered check
+    summary_rows = "".join(
+        f"""
+                <tr>
+                    <td>{check.summary}</td>
+                    <td class="{statuses[check.name].lower()}">{statuses[check.name]}</td>
+                </tr>"""
+        for check in CHECKS
+    )
     # Define colors for header background
     header_color = "#337AB7"  # Light Blue
     # Generate HTML content for health check summary
@@ -567,6 +2672,10 @@ def send_email(
                 background-color: #FF0000; /* Red */
                 color: white;
             }}
+            .skipped {{
+                background-color: #D3D3D3; /* Grey */
+                color: white;
+            }}
         </style>
     </head>
     <body>
@@ -580,45 +2689,653 @@ def send_email(
                     <th>Check</th>
                     <th>Status</th>
                 </tr>
-                <tr>
-                    <td>All Nodes are in Ready state</td>
-                    <td class="{node_status.lower()}">{node_status}</td>
-                </tr>
-                <tr>
-                    <td>All Pods are in Running state</td>
-                    <td class="{pods_status.lower()}">{pods_status}</td>
-                </tr>
-                <tr>
-                    <td>Velero backup is present</td>
-                    <td class="{backup_status.lower()}">{backup_status}</td>
-                </tr>
+{summary_rows}
             </table>
         </div>
     </body>
     </html>
     """
-    # Attach HTML content
-    msg.attach(MIMEText(summary_html, "html"))
-    # Attach the PDF file
-    try:
-        with open(pdf_file_path, "rb") as attachment:
-            part = MIMEBase("application", "octet-stream")
-            part.set_payload(attachment.read())
-            encoders.encode_base64(part)
-            part.add_header(
-                "Content-Disposition", f"attachment; filename= {pdf_file_path}"
+    return mailer.deliver(recipients, subject, summary_html, report_path)  ###Main function
+
+# Function to build the path of a new report
+def report_file_path(cluster_name):
+    # Get the current date and time as a formatted string
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    # Generate the report file name with cluster name, timestamp and format
+    report_file_name = f"{cluster_name}_health_check_report_{timestamp}.{report_format}"
+
+    # Combine the directory path and file name to create the full file path
+    return os.path.join(output_directory, report_file_name)
+
+
+# Function to add the report title, overview and start time
+def add_report_header(elements, cluster_name, start_time):
+    """
+    Add the title, overview, cluster information and start time to a report.
+    Args:
+      elements: The list of report elements to add to.
+      cluster_name: Name of the cluster, or clusters, covered by the report.
+      start_time: The datetime the health checks started at.
+    Returns:
+      None.
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER, TA_LEFT
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import Paragraph, Spacer
+
+    # Add a header to the PDF report
+    header_style = getSampleStyleSheet()["Heading1"]
+    header_style.alignment = TA_CENTER  # Center-align the header title
+    # Use a bold font for the header title
+    header_style.fontName = "Helvetica-Bold"
+    header_style.textColor = colors.HexColor("#337AB7")
+    # Blue color for the header title
+    header_text = f"Health Check Report of  {cluster_name}"
+    header_paragraph = Paragraph(header_text, header_style)
+    elements.append(header_paragraph)
+    elements.append(Spacer(1, 12))  # Add some space after the header title
+
+    # Add an overview section at the start with left alignment
+    overview_style = getSampleStyleSheet()["Heading2"]
+    overview_style.alignment = TA_LEFT  # Left-align the overview title
+    overview_text = "Overview:"
+    overview_paragraph = Paragraph(overview_text, overview_style)
+    elements.append(overview_paragraph)
+
+    # Add information related to the script
+    # One paragraph per enabled check, in report order
+    check_titles = ", ".join(check.title for check in CHECKS)
+    check_info_text = "".join(
+        f"""
+    <b>{check.title}:</b> {check.description}<br/><br/>
+"""
+        for check in CHECKS
+    )
+    script_info_text = f"""
+    This comprehensive report is designed to provide you with a detailed health assessment of EKS cluster. It covers: {check_titles}.<br/><br/>
+{check_info_text}
+    This report is designed to empower you with actionable insights, enabling you to make informed decisions and ensure the reliability of the EKS cluster. Our commitment to excellence in cluster health is reflected in every aspect of this assessment.
+
+    """
+    elements.append(Paragraph(script_info_text, getSampleStyleSheet()["Normal"]))
+    # Add some space after the script information
+    elements.append(Spacer(1, 12))
+
+    # Display cluster information
+    cluster_info_text = f"<b>Cluster:</b> {cluster_name}"
+    elements.append(Paragraph(cluster_info_text, getSampleStyleSheet()["Normal"]))
+    # Add some space after the script information
+    elements.append(Spacer(1, 12))
+
+    # Display start time, end time, and time elapsed in bold
+    elements.append(
+        Paragraph(
+            f"<font size='10'><b>Start Time:</b></font> {start_time.strftime('%Y-%m-%d %H:%M:%S')}",
+            getSampleStyleSheet()["Normal"],
+        )
+    )
+    # Add some space after the script information
+    elements.append(Spacer(1, 12))
+
+
+# Function to list the report sections of one cluster's check results
+def check_sections(results, title_prefix=""):
+    """
+    List the table of each check of one set of check results.
+    Args:
+      results: A dict mapping each check name to its (status, table_output) result.
+      title_prefix: Text put in front of each table title, e.g. the cluster name.
+    Returns:
+      A list of (title, table_type, rows) sections.
+    """
+    return [
+        (f"{title_prefix}{check.title}", check.table_type, results[check.name][1])
+        for check in CHECKS
+    ]
+
+
+# Function to yield the optional performance section once it is reached
+def performance_sections():
+    # The counters are read when the section is written, not when it is listed
+    if perf_report:
+        yield "Performance", "performance", performance_table()
+
+
+# Function to write the report as a PDF document
+def write_pdf_report(file_path, cluster_name, start_time, sections):
+    """
+    Lay out the report sections with reportlab and build the PDF document.
+    Args:
+      file_path: Path the report is written to.
+      cluster_name: Name of the cluster, or clusters, covered by the report.
+      start_time: The datetime the health checks started at.
+      sections: An iterable of (title, table_type, rows) sections.
+    Returns:
+      None.
+    """
+    from reportlab.lib.pagesizes import landscape, letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer
+
+    elements = []
+    add_report_header(elements, cluster_name, start_time)
+    with perf_stage("report_tables"):
+        # Health check sections with colored headers
+        for title, table_type, rows in sections:
+            generate_result_table(
+                f"<font size='10'><b>{title}:</b></font>",
+                rows,
+                elements,
+                table_type=table_type,
+                header_color="#337AB7",
             )
-            msg.attach(part)
-    except Exception as e:
-        raise Exception(f"Failed to attach PDF file: {e}")
-    # Send the email
+    elements.append(Spacer(1, 12))
+
+    # Record the end time
+    end_time = datetime.now()
+    time_elapsed = end_time - start_time
+    elements.append(
+        Paragraph(
+            f"<b>End Time:</b> {end_time.strftime('%Y-%m-%d %H:%M:%S')}",
+            getSampleStyleSheet()["Normal"],
+        )
+    )
+    elements.append(Spacer(1, 12))
+    # Add some space after the cluster information and timestamps
+    elements.append(
+        Paragraph(
+            f"<b>Time Elapsed:</b> {str(time_elapsed)} seconds",
+            getSampleStyleSheet()["Normal"],
+        )
+    )
+    # Build the PDF document with the elements
+    doc = SimpleDocTemplate(file_path, pagesize=landscape(letter))
+    with perf_stage("pdf_build"):
+        doc.build(elements)
+
+
+# Function to stream the report as an HTML page
+def write_html_report(file_path, cluster_name, start_time, sections):
+    """
+    Write the report sections to an HTML page row by row.
+    Args:
+      file_path: Path the report is written to.
+      cluster_name: Name of the cluster, or clusters, covered by the report.
+      start_time: The datetime the health checks started at.
+      sections: An iterable of (title, table_type, rows) sections.
+    Returns:
+      None.
+    """
+    from html import escape
+
+    with open(file_path, "w", encoding="utf-8") as report:
+        report.write(
+            "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+            f"<title>Health Check Report of {escape(cluster_name)}</title>\n"
+            "<style>\n"
+            "body { font-family: Arial, sans-serif; }\n"
+            "h1, h2 { color: #337AB7; }\n"
+            "table { border-collapse: collapse; margin-bottom: 12px; }\n"
+            "th, td { border: 1px solid black; padding: 4px 8px; font-family: Courier, monospace; }\n"
+            "th { background-color: #337AB7; color: white; }\n"
+            "td { background-color: beige; }\n"
+            "tr.ok td { background-color: white; }\n"
+            "tr.warning td { background-color: yellow; }\n"
+            "tr.failed td { background-color: red; }\n"
+            "</style>\n</head>\n<body>\n"
+            f"<h1>Health Check Report of {escape(cluster_name)}</h1>\n"
+            f"<p><b>Cluster:</b> {escape(cluster_name)}</p>\n"
+            f"<p><b>Start Time:</b> {start_time.strftime('%Y-%m-%d %H:%M:%S')}</p>\n"
+        )
+        for title, table_type, rows in sections:
+            rows = iter(rows)
+            header = next(rows, None)
+            if header is None:
+                continue
+            report.write(f"<h2>{escape(title)}</h2>\n<table>\n<tr>")
+            report.write("".join(f"<th>{escape(str(cell).strip())}</th>" for cell in header))
+            report.write("</tr>\n")
+            for row in rows:
+                state = row_state(table_type, row)
+                report.write(f'<tr class="{state}">' if state else "<tr>")
+                report.write("".join(f"<td>{escape(str(cell).strip())}</td>" for cell in row))
+                report.write("</tr>\n")
+            report.write("</table>\n")
+        end_time = datetime.now()
+        report.write(
+            f"<p><b>End Time:</b> {end_time.strftime('%Y-%m-%d %H:%M:%S')}</p>\n"
+            f"<p><b>Time Elapsed:</b> {str(end_time - start_time)} seconds</p>\n"
+            "</body>\n</html>\n"
+        )
+
+
+# Function to stream the report as CSV
+def write_csv_report(file_path, cluster_name, start_time, sections):
+    """
+    Write the report sections to a CSV file row by row. Each row starts with
+    the title of its section, so the file can be filtered per table.
+    Args:
+      file_path: Path the report is written to.
+      cluster_name: Name of the cluster, or clusters, covered by the report.
+      start_time: The datetime the health checks started at.
+      sections: An iterable of (title, table_type, rows) sections.
+    Returns:
+      None.
+    """
+    import csv
+
+    with open(file_path, "w", newline="", encoding="utf-8") as report:
+        writer = csv.writer(report)
+        writer.writerow(["Cluster", cluster_name])
+        writer.writerow(["Start Time", start_time.strftime("%Y-%m-%d %H:%M:%S")])
+        for title, _, rows in sections:
+            writer.writerows([title, *(str(cell).strip() for cell in row)] for row in rows)
+        writer.writerow(["End Time", datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
+
+
+# Function to stream the report as JSON
+def write_json_report(file_path, cluster_name, start_time, sections):
+    """
+    Write the report sections to a JSON document row by row. Rows are objects
+    keyed by the header of their table.
+    Args:
+      file_path: Path the report is written to.
+      cluster_name: Name of the cluster, or clusters, covered by the report.
+      start_time: The datetime the health checks started at.
+      sections: An iterable of (title, table_type, rows) sections.
+    Returns:
+      None.
+    """
+    with open(file_path, "w", encoding="utf-8") as report:
+        report.write(
+            f'{{"cluster": {json.dumps(cluster_name)}, '
+            f'"start_time": {json.dumps(start_time.isoformat())}, "sections": ['
+        )
+        for index, (title, table_type, rows) in enumerate(sections):
+            rows = iter(rows)
+            header = [str(cell).strip() for cell in next(rows, [])]
+            report.write(
+                f'{"," if index else ""}\n{{"title": {json.dumps(title)}, '
+                f'"type": {json.dumps(table_type)}, "rows": ['
+            )
+            for row_index, row in enumerate(rows):
+                record = {
+                    key: cell.strip() if isinstance(cell, str) else cell
+                    for key, cell in zip(header, row)
+                }
+                report.write(f'{"," if row_index else ""}\n{json.dumps(record)}')
+            report.write("]}")
+        report.write(f'], "end_time": {json.dumps(datetime.now().isoformat())}}}\n')
+
+
+# Pod table rows counting healthy pods that were left out of the table
+OMITTED_PODS_PATTERN = re.compile(r"^\(\d+ more pods in (\d+) workloads?\)$")
+
+
+# Function to list the running checks that take part in snapshots
+def snapshot_checks():
+    return [(check.name, check.key_columns) for check in CHECKS if check.key_columns]
+
+
+# Function to take a compact snapshot of a run's check results
+def take_snapshot(results, previous=None):
+    """
+    Reduce check results to the state needed to diff the next run against:
+    a short hash and status per failing object, and the kubelet version of
+    every node. Healthy objects are not stored, so the snapshot of a stable
+    cluster stays small.
+    Args:
+      results: A dict mapping each check name to its (status, table_output) result.
+      previous: The snapshot of the previous run. The state of a check that
+        did not complete is carried over from it.
+    Returns:
+      The snapshot as a JSON-serializable dict.
+    """
+    from hashlib import blake2b
+
+    checks = {}
+    for check, key_columns in snapshot_checks():
+        status, table = results[check]
+        if not table:
+            # The check timed out or raised, keep what was known before
+            checks[check] = ((previous or {}).get("checks") or {}).get(check, {"failing": {}})
+            continue
+        failing = {}
+        versions = {}
+        for row in table[1:]:
+            cells = [str(cell).strip() for cell in row]
+            key = "/".join(cells[:key_columns])
+            if check == "pods" and OMITTED_PODS_PATTERN.match(cells[1]):
+                continue
+            if check == "nodes":
+                versions[key] = cells[1]
+            if row_state(CHECK_REGISTRY[check].table_type, row) == "failed":
+                digest = blake2b("|".join(cells).encode(), digest_size=8).hexdigest()
+                failing[key] = [digest, cells[-1]]
+        checks[check] = {"failing": failing}
+        if check == "nodes":
+            checks[check]["versions"] = versions
+    return {"taken_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "checks": checks}
+
+
+# Function to list what changed between two snapshots
+def diff_snapshots(previous, current, results):
+    """
+    Compare the snapshot of this run with the one of the previous run.
+    Args:
+      previous: The snapshot of the previous run.
+      current: The snapshot of this run.
+      results: The check results `current` was taken from.
+    Returns:
+      A table of changes: new failures, failures whose state changed,
+      recoveries and node version drift, starting with the header.
+    """
+    changes = [["Check", "Object", "Status", "Change"]]
+    for check, _ in snapshot_checks():
+        before = previous["checks"].get(check, {})
+        after = current["checks"][check]
+        if results[check][0] == "SKIPPED":
+            continue
+        if not results[check][1]:
+            changes.append([check, "-", "FAILED", "Check did not complete"])
+            continue
+        failing_before = before.get("failing", {})
+        for key, (digest, status) in after["failing"].items():
+            if key not in failing_before:
+                changes.append([check, key, status, "New failure"])
+            elif failing_before[key][0] != digest:
+                changes.append([check, key, status, "Changed"])
+        for key in failing_before.keys() - after["failing"].keys():
+            changes.append([check, key, "-", "Recovered"])
+        versions_before = before.get("versions", {})
+        for key, version in after.get("versions", {}).items():
+            if key in versions_before and versions_before[key] != version:
+                changes.append(
+                    [check, key, f"{versions_before[key]} -> {version}", "Version drift"]
+                )
+    return changes
+
+
+# Function to name the snapshot of a cluster
+def snapshot_name(cluster_name):
+    # ConfigMap names must be lowercase DNS labels
+    name = re.sub(r"[^a-z0-9-]+", "-", str(cluster_name).lower()).strip("-")
+    return f"k8shealthcheck-snapshot-{name or 'cluster'}"
+
+
+# Function to load the snapshot of the previous run
+def load_snapshot(cluster_name):
+    """
+    Read the snapshot of the previous run from `snapshot_store`.
+    Args:
+      cluster_name: Name of the cluster the snapshot belongs to.
+    Returns:
+      The snapshot dict, or None when there is none yet or snapshots are disabled.
+    """
+    if snapshot_store == "file":
+        path = os.path.join(snapshot_directory, f"{snapshot_name(cluster_name)}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as snapshot_file:
+            return json.load(snapshot_file)
+    if snapshot_store == "configmap":
+        from kubernetes import client
+        from kubernetes.client.rest import ApiException
+
+        try:
+            config_map = call_api(
+                client.CoreV1Api(get_api_client()).read_namespaced_config_map,
+                snapshot_name(cluster_name),
+                snapshot_namespace,
+            )
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+        return json.loads((config_map.data or {}).get("snapshot.json", "null"))
+    return None
+
+
+# Function to save the snapshot of this run
+def save_snapshot(cluster_name, snapshot):
+    """
+    Write the snapshot of this run to `snapshot_store`.
+    Args:
+      cluster_name: Name of the cluster the snapshot belongs to.
+      snapshot: The snapshot dict.
+    Returns:
+      None.
+    """
+    data = json.dumps(snapshot, separators=(",", ":"), sort_keys=True)
+    if snapshot_store == "file":
+        path = os.path.join(snapshot_directory, f"{snapshot_name(cluster_name)}.json")
+        # Write to a temporary file first so an interrupted run keeps the old snapshot
+        with open(f"{path}.tmp", "w", encoding="utf-8") as snapshot_file:
+            snapshot_file.write(data)
+        os.replace(f"{path}.tmp", path)
+    elif snapshot_store == "configmap":
+        from kubernetes import client
+        from kubernetes.client.rest import ApiException
+
+        api = client.CoreV1Api(get_api_client())
+        body = client.V1ConfigMap(
+            metadata=client.V1ObjectMeta(name=snapshot_name(cluster_name)),
+            data={"snapshot.json": data},
+        )
+        try:
+            call_api(
+                api.replace_namespaced_config_map,
+                snapshot_name(cluster_name),
+                snapshot_namespace,
+                body,
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            call_api(api.create_namespaced_config_map, snapshot_namespace, body)
+
+
+# Function to list the report sections of a cluster, diffed against the previous run
+def cluster_sections(cluster_name, results, title_prefix=""):
+    """
+    List the report sections of one cluster. When a snapshot of the previous
+    run exists, only the changes since that run are listed.
+    Args:
+      cluster_name: Name of the cluster.
+      results: A dict mapping each check name to its (status, table_output) result.
+      title_prefix: Text put in front of each table title, e.g. the cluster name.
+    Returns:
+      A (sections, snapshot) tuple. The snapshot is None when snapshots are
+      disabled, otherwise it is to be saved with `save_snapshot` once the
+      report has been sent.
+    """
+    if snapshot_store not in ("file", "configmap"):
+        return check_sections(results, title_prefix), None
+    previous = load_snapshot(cluster_name)
+    snapshot = take_snapshot(results, previous)
+    if previous is None:
+        return check_sections(results, title_prefix), snapshot
+    changes = diff_snapshots(previous, snapshot, results)
+    print_color(
+        f"{len(changes) - 1} changes since the previous run of {cluster_name}",
+        RED if len(changes) > 1 else GREEN,
+    )
+    title = f"{title_prefix}Changes since {previous['taken_at']}"
+    return [(title, "changes", changes)], snapshot
+
+
+# Function to save snapshots once the report they were diffed for has been sent
+def save_snapshots_when_sent(delivery, snapshots):
+    """
+    Args:
+      delivery: The `Future` returned by `send_email`.
+      snapshots: A dict mapping each cluster to its snapshot, or to None when
+        snapshots are disabled.
+    Returns:
+      None.
+    """
+
+    def save(future):
+        if future.exception() is not None:
+            return
+        for cluster, snapshot in snapshots.items():
+            if snapshot is not None:
+                try:
+                    save_snapshot(cluster, snapshot)
+                except Exception as e:
+                    print_color(f"Error while saving the snapshot of {cluster}: {str(e)}", RED)
+
+    delivery.add_done_callback(save)
+
+
+# Report writers by report format
+REPORT_WRITERS = {
+    "pdf": write_pdf_report,
+    "html": write_html_report,
+    "csv": write_csv_report,
+    "json": write_json_report,
+}
+
+
+# Function to write the report in the configured format
+def write_report(file_path, cluster_name, start_time, sections):
+    """
+    Write the report sections with the writer of `report_format`.
+    The html, csv and json writers stream each row to disk as it is reached
+    instead of laying out the whole document in memory.
+    Args:
+      file_path: Path the report is written to.
+      cluster_name: Name of the cluster, or clusters, covered by the report.
+      start_time: The datetime the health checks started at.
+      sections: An iterable of (title, table_type, rows) sections.
+    Returns:
+      None.
+    """
+    writer = REPORT_WRITERS.get(report_format)
+    if writer is None:
+        raise ValueError(
+            f"Unsupported report_format '{report_format}', use one of {', '.join(REPORT_WRITERS)}."
+        )
+    if report_format == "pdf":
+        writer(file_path, cluster_name, start_time, sections)
+    else:
+        with perf_stage("report_write"):
+            writer(file_path, cluster_name, start_time, sections)
+    # Print the report file path
+    print_color(f"Report generated: {file_path}", GREEN)
+
+
+# Function to append the results of a run to the history database
+def record_history(cluster_results, start_time):
+    if not history_database:
+        return
+    # A history failure must not keep the report from being sent
     try:
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, recipients, msg.as_string())
+        from history import record_results
+
+        with perf_stage("history"):
+            record_results(cluster_results, start_time, history_database)
     except Exception as e:
-        raise Exception(f"Failed to send email: {e}")  ###Main function
+        print_color(f"Error while recording the run history: {str(e)}", RED)
+
+
+# Function to build the report for a set of check results and email it
+def generate_report(cluster_name, results, start_time):
+    """
+    Write the health check report and send it to the recipients.
+    Args:
+      cluster_name: Name of the cluster.
+      results: A dict mapping each check name to its (status, table_output) result,
+        as returned by `run_checks`.
+      start_time: The datetime the health checks started at.
+    Returns:
+      The path of the generated report file.
+    """
+    # Record the results first, so the history does not depend on the report being sent
+    record_history({cluster_name: results}, start_time)
+    # Generate healthcheck summary
+    generate_summary(results)
+    result_sections, snapshot = cluster_sections(cluster_name, results)
+    sections = chain(
+        result_sections,
+        [("Health Check Summary", "summary", summary_data)],
+        performance_sections(),
+    )
+    report_path = report_file_path(cluster_name)
+    write_report(report_path, cluster_name, start_time, sections)
+    # send email
+    delivery = send_email(
+        recipients,
+        cluster_name,
+        report_path,
+        {name: status for name, (status, _) in results.items()},
+    )
+    # Only remember this run once its changes have been reported
+    save_snapshots_when_sent(delivery, {cluster_name: snapshot})
+    return report_path
+
+
+# Function to build one consolidated report for several clusters and email it
+def generate_multi_cluster_report(report_name, cluster_results, start_time):
+    """
+    Write one report with a consolidated summary of every cluster followed
+    by the tables of each cluster, and send it to the recipients.
+    Args:
+      report_name: Name used for the report file name.
+      cluster_results: A dict mapping each cluster to its check results, as
+        returned by `run_clusters`.
+      start_time: The datetime the health checks started at.
+    Returns:
+      The path of the generated report file.
+    """
+    # Record the results first, so the history does not depend on the report being sent
+    record_history(cluster_results, start_time)
+    check_names = [check.name for check in CHECKS]
+    # Consolidated summary, one row per cluster and one column per check
+    consolidated = [["Cluster", *(check.title for check in CHECKS), "Overall"]]
+    for cluster, results in cluster_results.items():
+        statuses = [results[check][0] for check in check_names]
+        # A cluster none of whose checks ran is not reported as healthy
+        if "FAILED" in statuses:
+            overall = "FAILED"
+        elif "PASSED" in statuses:
+            overall = "PASSED"
+        else:
+            overall = "SKIPPED"
+        consolidated.append([cluster, *statuses, overall])
+    snapshots = {}
+    per_cluster_sections = []
+    for cluster, results in cluster_results.items():
+        sections, snapshots[cluster] = cluster_sections(
+            cluster, results, title_prefix=f"{cluster} - "
+        )
+        per_cluster_sections.extend(sections)
+    sections = chain(
+        [("Consolidated Health Check Summary", "summary", consolidated)],
+        per_cluster_sections,
+        performance_sections(),
+    )
+    report_path = report_file_path(report_name)
+    write_report(report_path, ", ".join(cluster_results), start_time, sections)
+
+    # The email summary shows a check as failed when it failed on any cluster,
+    # and as passed only when it passed on every cluster
+    statuses = {}
+    for check in check_names:
+        check_statuses = {r[check][0] for r in cluster_results.values()}
+        if "FAILED" in check_statuses:
+            statuses[check] = "FAILED"
+        elif check_statuses == {"PASSED"}:
+            statuses[check] = "PASSED"
+        else:
+            statuses[check] = "SKIPPED"
+    delivery = send_email(recipients, report_name, report_path, statuses)
+    # Only remember this run once its changes have been reported
+    save_snapshots_when_sent(delivery, snapshots)
+    return report_path
+
 
 if __name__ == "__main__":
     ##Print start time
@@ -635,139 +3352,20 @@ if __name__ == "__main__":
             f"####################### Starting Health Checks for {cluster_name} cluster #######################",
             GREEN,
         )
-        # Get the current date and time as a formatted string
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-
-        # Generate the PDF file name with cluster name and timestamp
-        pdf_file_name = f"{cluster_name}_health_check_report_{timestamp}.pdf"
-
-        # Combine the directory path and file name to create the full file path
-        pdf_file_path = os.path.join(output_directory, pdf_file_name)
-
-        doc = SimpleDocTemplate(pdf_file_path, pagesize=landscape(letter))
-        elements = []
-
-        # Add a header to the PDF report
-        header_style = getSampleStyleSheet()["Heading1"]
-        header_style.alignment = TA_CENTER  # Center-align the header title
-        # Use a bold font for the header title
-        header_style.fontName = "Helvetica-Bold"
-        header_style.textColor = colors.HexColor("#337AB7")
-        # Blue color for the header title
-        header_text = f"Health Check Report of  {cluster_name}"
-        header_paragraph = Paragraph(header_text, header_style)
-        elements.append(header_paragraph)
-        elements.append(Spacer(1, 12))  # Add some space after the header title
-
-        # Add an overview section at the start with left alignment
-        overview_style = getSampleStyleSheet()["Heading2"]
-        overview_style.alignment = TA_LEFT  # Left-align the overview title
-        overview_text = "Overview:"
-        overview_paragraph = Paragraph(overview_text, overview_style)
-        elements.append(overview_paragraph)
-
-        # Add information related to the script
-        script_info_text = """
-        This comprehensive report is designed to provide you with a detailed health assessment of EKS cluster. It covers three critical aspects: node status, pod status, Velero backup status and Subnets .<br/><br/>
-
-        <b>Subnets Count:</b> Verifies that all subnets in the account to ensure sufficient ipaddresses are available.<br/><br/>
-
-        <b>Node Status:</b> Verifies that all nodes in the cluster are in a ready state, ensuring the foundation of cluster is stable.<br/><br/>
-
-        <b>Pod Status:</b> Assesses the running status of pods across different namespaces, ensuring all system pods are operating smoothly.<br/><br/>
-
-        <b>Velero Backup Status:</b> Checks if Velero backups are present and completed, safeguarding your cluster's data and configurations.<br/><br/>
-
-        This report is designed to empower you with actionable insights, enabling you to make informed decisions and ensure the reliability of the EKS cluster. Our commitment to excellence in cluster health is reflected in every aspect of this assessment.
-
-        """
-        elements.append(Paragraph(script_info_text, getSampleStyleSheet()["Normal"]))
-        # Add some space after the script information
-        elements.append(Spacer(1, 12))
-
-        # Display cluster information
-        cluster_info_text = f"<b>Cluster:</b> {cluster_name}"
-        elements.append(Paragraph(cluster_info_text, getSampleStyleSheet()["Normal"]))
-        # Add some space after the script information
-        elements.append(Spacer(1, 12))
-
-        # Display start time, end time, and time elapsed in bold
-        elements.append(
-            Paragraph(
-                f"<font size='10'><b>Start Time:</b></font> {start_time.strftime('%Y-%m-%d %H:%M:%S')}",
-                getSampleStyleSheet()["Normal"],
+        if KUBE_CONTEXTS:
+            # Check every configured cluster and send one consolidated report
+            cluster_results = run_clusters(KUBE_CONTEXTS)
+            generate_multi_cluster_report(
+                cluster_name or "clusters", cluster_results, start_time
             )
-        )
-        # Add some space after the script information
-        elements.append(Spacer(1, 12))
-
-        # Health check sections with colored headers
-        node_status, node_table_output = check_nodes_ready()
-        generate_result_table(
-            "<font size='10'><b>Node Status:</b></font>",
-            node_table_output,
-            elements,
-            table_type="nodes",
-            header_color="#337AB7",
-        )
-        pods_status, pod_table_output = check_pods_running()
-        generate_result_table(
-            "<font size='10'><b>Pods Status:</b></font>",
-            pod_table_output,
-            elements,
-            table_type="pods",
-            header_color="#337AB7",
-        )
-        backup_status, backup_table_output = check_velero_backup()
-        generate_result_table(
-            "<font size='10'><b>Velero Status:</b></font>",
-            backup_table_output,
-            elements,
-            table_type="backup",
-            header_color="#337AB7",
-        )
-        # Generate healthcheck summary
-        summary = generate_summary(node_status, pods_status, backup_status)
-        generate_result_table(
-            "<font size='10'><b>Health Check Summary:</b></font>",
-            summary_data,
-            elements,
-            table_type="summary",
-            header_color="#337AB7",
-        )
-
-        elements.append(Spacer(1, 12))
+        else:
+            # Run all health checks in parallel
+            results = run_checks(CHECKS)
+            generate_report(cluster_name, results, start_time)
+        # Wait for the email to go out before the process exits
+        from mailer import wait_for_deliveries
 
-        # Record the end time
-        end_time = datetime.now()
-        time_elapsed = end_time - start_time
-        elements.append(
-            Paragraph(
-                f"<b>End Time:</b> {end_time.strftime('%Y-%m-%d %H:%M:%S')}",
-                getSampleStyleSheet()["Normal"],
-            )
-        )
-        elements.append(Spacer(1, 12))
-        # Add some space after the cluster information and timestamps
-        elements.append(
-            Paragraph(
-                f"<b>Time Elapsed:</b> {str(time_elapsed)} seconds",
-                getSampleStyleSheet()["Normal"],
-            )
-        )
-        # Build the PDF document with the elements
-        doc.build(elements)
-        # Print the PDF file path
-        print_color(f"PDF report generated: {pdf_file_path}", GREEN)
-        # send email
-        send_email(
-            recipients,
-            cluster_name,
-            pdf_file_path,
-            node_status,
-            pods_status,
-            backup_status,
-        )
+        wait_for_deliveries()
     except Exception as e:
         print_color(f"Error: {str(e)}", RED)
     except KeyboardInterrupt:
@@ -775,6 +3373,8 @@ if __name__ == "__main__":
         print_color("\nKeyboard interruption detected. Exiting gracefully.", RED)
         exit(1)
     finally:
+        # Print the per-stage performance breakdown
+        emit_perf_stats(os.environ.get("cluster_name"))
         # Calculate and print execution time
         end_time = datetime.now()
         execution_time = end_time - start_time
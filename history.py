@@ -0,0 +1,349 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from healthcheck import (
+    CHECK_REGISTRY,
+    OMITTED_PODS_PATTERN,
+    history_database,
+    history_retention_days,
+    print_color,
+    row_state,
+    GREEN,
+    NC,
+)
+
+# Runs, the status of each check, and per scope the number of objects seen and
+# failing. Only failing objects are stored one by one, so a run of a healthy
+# cluster adds a handful of rows whatever its size.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    cluster TEXT NOT NULL,
+    started_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_cluster_started ON runs (cluster, started_at);
+CREATE TABLE IF NOT EXISTS check_results (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    check_name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    observed INTEGER NOT NULL,
+    PRIMARY KEY (run_id, check_name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS scopes (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    check_name TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    objects INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    PRIMARY KEY (check_name, scope, run_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS objects (
+    id INTEGER PRIMARY KEY,
+    cluster TEXT NOT NULL,
+    check_name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    UNIQUE (cluster, check_name, key)
+);
+CREATE TABLE IF NOT EXISTS failures (
+    object_id INTEGER NOT NULL REFERENCES objects (id) ON DELETE CASCADE,
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    PRIMARY KEY (object_id, run_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS failures_run ON failures (run_id);
+"""
+
+
+# Function to reduce a check table to its objects
+def table_outcomes(check, table):
+    """
+    Args:
+      check: The registered `Check` the table belongs to.
+      table: The check's table output, header row first.
+    Returns:
+      A list of (key, scope, failed, objects) tuples, one per row standing for
+      objects of the table. Indented rows drill into the row above, so they are
+      left out. A row summing up healthy workloads left out of the report has
+      no key and counts them as passing objects.
+    """
+    outcomes = []
+    for row in table[1:]:
+        if str(row[0])[:1].isspace():
+            continue
+        cells = [str(cell).strip() for cell in row]
+        scope = cells[check.scope_column] if check.scope_column is not None else ""
+        omitted = OMITTED_PODS_PATTERN.match(cells[1] if len(cells) > 1 else "")
+        if omitted:
+            outcomes.append((None, scope, False, int(omitted.group(1))))
+            continue
+        key = "/".join(cells[: check.key_columns or 1])
+        outcomes.append((key, scope, row_state(check.table_type, row) == "failed", 1))
+    return outcomes
+
+
+class HistoryStore:
+    """
+    An append-only SQLite store of check results, one run at a time, with
+    failure rate and time to recovery queries over a time window.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or history_database
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        # Incremental auto-vacuum lets compact() give freed pages back. It has to
+        # be set before the first table is written, and a file created without
+        # it is converted by one full VACUUM.
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        if self.db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            self.db.execute("VACUUM")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record_run(self, cluster, started_at, results):
+        """
+        Append the results of one run.
+        Args:
+          cluster: Name of the cluster the checks ran against.
+          started_at: The datetime the health checks started at.
+          results: A dict mapping each check name to its (status, table_output)
+            result, as returned by `run_checks`.
+        Returns:
+          The id of the recorded run.
+        """
+        cluster = cluster or ""
+        with self.lock, self.db:
+            run_id = self.db.execute(
+                "INSERT INTO runs (cluster, started_at) VALUES (?, ?)",
+                (cluster, int(started_at.timestamp())),
+            ).lastrowid
+            for name, (status, table) in results.items():
+                check = CHECK_REGISTRY.get(name)
+                if check is None or status == "SKIPPED":
+                    continue
+                self.db.execute(
+                    "INSERT INTO check_results VALUES (?, ?, ?, ?)",
+                    (run_id, name, status, int(bool(table))),
+                )
+                if not table:
+                    continue
+                # scope -> [objects, failures]
+                scopes = {}
+                failing = []
+                for key, scope, failed, objects in table_outcomes(check, table):
+                    counts = scopes.setdefault(scope, [0, 0])
+                    counts[0] += objects
+                    if failed:
+                        counts[1] += 1
+                        failing.append((cluster, name, key, scope))
+                self.db.executemany(
+                    "INSERT INTO scopes VALUES (?, ?, ?, ?, ?)",
+                    [(run_id, name, scope, n, f) for scope, (n, f) in scopes.items()],
+                )
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO objects (cluster, check_name, key, scope) VALUES (?, ?, ?, ?)",
+                    failing,
+                )
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO failures SELECT id, ? FROM objects"
+                    " WHERE cluster = ? AND check_name = ? AND key = ?",
+                    [(run_id, cluster, name, key) for cluster, name, key, _ in failing],
+                )
+        return run_id
+
+    def compact(self, retention_days=None):
+        """
+        Delete runs older than `retention_days`, the objects no remaining run
+        failed on, and give the freed pages back to the file system.
+        Returns:
+          The number of runs deleted.
+        """
+        days = history_retention_days if retention_days is None else retention_days
+        cutoff = int(time.time() - days * 86400)
+        with self.lock:
+            with self.db:
+                deleted = self.db.execute(
+                    "DELETE FROM runs WHERE started_at < ?", (cutoff,)
+                ).rowcount
+                self.db.execute(
+                    "DELETE FROM objects WHERE id NOT IN (SELECT object_id FROM failures)"
+                )
+            # execute() only steps the pragma once, freeing a single page;
+            # executescript() runs it to completion
+            self.db.executescript("PRAGMA incremental_vacuum;")
+            # The file only shrinks once the WAL is written back to it
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return deleted
+
+    def _window(self, cluster, since_days):
+        clauses, params = [], []
+        if cluster:
+            clauses.append("runs.cluster = ?")
+            params.append(cluster)
+        if since_days is not None:
+            clauses.append("runs.started_at >= ?")
+            params.append(int(time.time() - since_days * 86400))
+        return "".join(f" AND {clause}" for clause in clauses), params
+
+    def failure_rate(self, check, cluster=None, since_days=None):
+        """
+        Share of the objects of a check that were failing, per scope.
+        Args:
+          check: Name of the check, e.g. "pods".
+          cluster: Only count runs against this cluster, None for all.
+          since_days: Only count runs of the last `since_days` days, None for all.
+        Returns:
+          A dict mapping each scope (namespace, node group, ...) to a dict with
+          the "objects" seen over all runs, the "failures" among them and the
+          failure "rate".
+        """
+        window, params = self._window(cluster, since_days)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT scopes.scope, SUM(scopes.objects), SUM(scopes.failures)"
+                " FROM scopes JOIN runs ON runs.id = scopes.run_id"
+                f" WHERE scopes.check_name = ?{window} GROUP BY scopes.scope ORDER BY scopes.scope",
+                [check, *params],
+            ).fetchall()
+        return {
+            scope: {"objects": objects, "failures": failures, "rate": round(failures / objects, 4)}
+            for scope, objects, failures in rows
+            if objects
+        }
+
+    def check_failure_rate(self, cluster=None, since_days=None):
+        """
+        Share of runs each check failed in.
+        Returns:
+          A dict mapping each check name to a dict with its "runs", "failed" runs and "rate".
+        """
+        window, params = self._window(cluster, since_days)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT check_results.check_name, COUNT(*), SUM(check_results.status = 'FAILED')"
+                " FROM check_results JOIN runs ON runs.id = check_results.run_id"
+                f" WHERE 1 = 1{window} GROUP BY check_results.check_name",
+                params,
+            ).fetchall()
+        return {
+            name: {"runs": runs, "failed": failed, "rate": round(failed / runs, 4)}
+            for name, runs, failed in rows
+        }
+
+    def mttr(self, check, cluster=None, since_days=None):
+        """
+        Mean time to recovery per scope: how long an object kept failing, from
+        the first run it failed in to the first later run of its cluster in
+        which the check completed without it failing.
+        Args:
+          check: Name of the check, e.g. "pods".
+          cluster: Only count runs against this cluster, None for all.
+          since_days: Only count runs of the last `since_days` days, None for all.
+        Returns:
+          A dict mapping each scope to a dict with the number of "recoveries"
+          and the "mttr_seconds", and the number of objects still "failing".
+        """
+        window, params = self._window(cluster, since_days)
+        with self.lock:
+            # Runs the check completed in, in order, per cluster
+            runs = {}
+            for run_id, run_cluster, started_at in self.db.execute(
+                "SELECT runs.id, runs.cluster, runs.started_at"
+                " FROM check_results JOIN runs ON runs.id = check_results.run_id"
+                f" WHERE check_results.check_name = ? AND check_results.observed = 1{window}"
+                " ORDER BY runs.cluster, runs.started_at, runs.id",
+                [check, *params],
+            ):
+                runs.setdefault(run_cluster, []).append((run_id, started_at))
+            failures = self.db.execute(
+                "SELECT objects.id, objects.cluster, objects.scope, failures.run_id"
+                " FROM failures JOIN objects ON objects.id = failures.object_id"
+                " WHERE objects.check_name = ? ORDER BY objects.id",
+                (check,),
+            ).fetchall()
+        positions = {
+            run_id: (position, started_at)
+            for cluster_runs in runs.values()
+            for position, (run_id, started_at) in enumerate(cluster_runs)
+        }
+        # object id -> (cluster, scope, positions of the runs it failed in)
+        failed_in = {}
+        for object_id, object_cluster, scope, run_id in failures:
+            if run_id in positions:
+                failed_in.setdefault(object_id, (object_cluster, scope, []))[2].append(
+                    positions[run_id][0]
+                )
+        # scope -> [recoveries, total seconds, still failing]
+        totals = {}
+        for object_cluster, scope, failed_positions in failed_in.values():
+            cluster_runs = runs[object_cluster]
+            counts = totals.setdefault(scope, [0, 0, 0])
+            failed_positions.sort()
+            started = failed_positions[0]
+            for current, following in zip(failed_positions, failed_positions[1:] + [None]):
+                if following == current + 1:
+                    continue
+                if current + 1 < len(cluster_runs):
+                    counts[0] += 1
+                    counts[1] += cluster_runs[current + 1][1] - cluster_runs[started][1]
+                else:
+                    counts[2] += 1
+                started = following
+        return {
+            scope: {
+                "recoveries": recoveries,
+                "mttr_seconds": round(seconds / recoveries, 1) if recoveries else None,
+                "failing": failing,
+            }
+            for scope, (recoveries, seconds, failing) in sorted(totals.items())
+        }
+
+
+# Function to append a run to the configured history database
+def record_results(cluster_results, started_at, path=None):
+    """
+    Record the results of every cluster of a run and drop expired runs.
+    Args:
+      cluster_results: A dict mapping each cluster name to its check results.
+      started_at: The datetime the health checks started at.
+      path: The SQLite file, defaults to `history_database`.
+    Returns:
+      None.
+    """
+    store = HistoryStore(path)
+    try:
+        for cluster, results in cluster_results.items():
+            store.record_run(cluster, started_at, results)
+        store.compact()
+    finally:
+        store.close()
+    print_color(f"Results recorded in {store.path}", GREEN)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the health check history.")
+    parser.add_argument("query", choices=["failure-rate", "check-failure-rate", "mttr"])
+    parser.add_argument("check", nargs="?", default="pods")
+    parser.add_argument("--cluster")
+    parser.add_argument("--since-days", type=float)
+    parser.add_argument("--database", default=history_database)
+    args = parser.parse_args()
+    if not args.database:
+        parser.error("set history_database or pass --database")
+    store = HistoryStore(args.database)
+    try:
+        if args.query == "failure-rate":
+            answer = store.failure_rate(args.check, args.cluster, args.since_days)
+        elif args.query == "mttr":
+            answer = store.mttr(args.check, args.cluster, args.since_days)
+        else:
+            answer = store.check_failure_rate(args.cluster, args.since_days)
+    finally:
+        store.close()
+    print_color(json.dumps(answer, indent=2), NC)
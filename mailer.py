@@ -0,0 +1,372 @@
+import base64
+import gzip
+import os
+import queue
+import random
+import shutil
+import smtplib
+import threading
+import time
+import uuid
+from concurrent.futures import Future, wait
+from email.header import Header
+from email.utils import formatdate, make_msgid
+from healthcheck import print_color, perf_stage, GREEN, RED
+
+# Email configuration
+sender_email = os.environ.get("SENDER_EMAIL")
+sender_password = os.environ.get("SENDER_PASSWORD")
+smtp_server = os.environ.get("SMTP_SERVER")
+smtp_port = int(os.environ.get("SMTP_PORT") or 587)
+# Seconds to wait for the SMTP server on each command
+smtp_timeout = float(os.environ.get("smtp_timeout", 60))
+# Log in without STARTTLS when the server does not offer it, only for local test relays
+smtp_allow_plaintext = os.environ.get("smtp_allow_plaintext", "false").lower() == "true"
+# Attempts to deliver a message before giving up, and the base backoff between them
+smtp_retries = int(os.environ.get("smtp_retries", 3))
+smtp_backoff = float(os.environ.get("smtp_backoff", 2))
+# Recipients per SMTP transaction, servers commonly reject more than 100
+smtp_batch_size = int(os.environ.get("smtp_batch_size", 50))
+# Attachments above this many bytes are gzipped, and linked instead when still too large
+email_attachment_limit = int(os.environ.get("email_attachment_limit", 10 * 1024 * 1024))
+# Base URL the report directory is published under, used to link large reports
+report_link_base = os.environ.get("report_link_base", "")
+# Bytes read per attachment chunk: 57 bytes encode to one 76-character base64 line
+ENCODE_CHUNK = 57 * 1024
+
+
+class DeliveryError(Exception):
+    """A message could not be delivered after all retries."""
+
+
+# Function to tell transient SMTP failures from permanent ones
+def is_retryable(error):
+    if isinstance(
+        error,
+        (
+            smtplib.SMTPAuthenticationError,
+            smtplib.SMTPRecipientsRefused,
+            smtplib.SMTPNotSupportedError,
+        ),
+    ):
+        return False
+    if isinstance(error, smtplib.SMTPResponseException):
+        # 4xx replies are temporary, 5xx replies are permanent
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPException, OSError))
+
+
+# Function to keep the report small enough to attach
+def prepare_attachment(report_path, limit=email_attachment_limit):
+    """
+    Decide how a report is sent. Reports up to `limit` bytes are attached as
+    they are. Larger ones are gzipped, and when even the compressed file is
+    too large a link under `report_link_base` is sent instead, if one is set.
+    Args:
+      report_path: Path of the report file.
+      limit: Largest attachment size in bytes.
+    Returns:
+      A (attachment_path, content_type, link) tuple. attachment_path is None
+      when the report is linked.
+    """
+    if os.path.getsize(report_path) <= limit:
+        return report_path, "application/octet-stream", None
+    compressed_path = f"{report_path}.gz"
+    with open(report_path, "rb") as report, gzip.open(compressed_path, "wb") as compressed:
+        shutil.copyfileobj(report, compressed, ENCODE_CHUNK)
+    if os.path.getsize(compressed_path) <= limit:
+        return compressed_path, "application/gzip", None
+    if report_link_base:
+        os.remove(compressed_path)
+        link = f"{report_link_base.rstrip('/')}/{os.path.basename(report_path)}"
+        return None, None, link
+    print_color(
+        "Compressed report is above email_attachment_limit and report_link_base is not set, attaching it anyway",
+        RED,
+    )
+    return compressed_path, "application/gzip", None
+
+
+# Function to encode a header value that may not be ASCII
+def _header(value):
+    return Header(value, "utf-8").encode() if not value.isascii() else value
+
+
+# Function to yield a MIME message piece by piece
+def message_chunks(sender, recipients, subject, html, attachment_path, content_type):
+    """
+    Yield the message as CRLF-terminated byte chunks, base64-encoding the
+    attachment as it is read, so the report is never held in memory.
+    Every body line is base64, so no line starts with "." and the message
+    needs no dot-stuffing in the SMTP DATA phase.
+    Args:
+      sender: The From address.
+      recipients: All recipients, shown in the To header.
+      subject: The subject line.
+      html: The HTML body.
+      attachment_path: Path of the file to attach, or None.
+      content_type: MIME type of the attachment.
+    Yields:
+      Byte strings, the last one ending with CRLF.
+    """
+    boundary = f"=={uuid.uuid4().hex}=="
+    yield (
+        f"From: {sender}\r\n"
+        f"To: {', '.join(recipients)}\r\n"
+        f"Subject: {_header(subject)}\r\n"
+        f"Date: {formatdate(localtime=True)}\r\n"
+        f"Message-ID: {make_msgid()}\r\n"
+        "MIME-Version: 1.0\r\n"
+        f'Content-Type: multipart/mixed; boundary="{boundary}"\r\n'
+        "\r\n"
+        f"--{boundary}\r\n"
+        'Content-Type: text/html; charset="utf-8"\r\n'
+        "Content-Transfer-Encoding: base64\r\n"
+        "\r\n"
+    ).encode()
+    yield base64.encodebytes(html.encode()).replace(b"\n", b"\r\n")
+    if attachment_path:
+        filename = os.path.basename(attachment_path)
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            "Content-Transfer-Encoding: base64\r\n"
+            f'Content-Disposition: attachment; filename="{filename}"\r\n'
+            "\r\n"
+        ).encode()
+        with open(attachment_path, "rb") as attachment:
+            while True:
+                chunk = attachment.read(ENCODE_CHUNK)
+                if not chunk:
+                    break
+                yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+    yield f"--{boundary}--\r\n".encode()
+
+
+class Mailer:
+    """
+    An SMTP connection that is kept open and reused for every message and
+    recipient batch, and reopened when the server has dropped it.
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None):
+        self.host = host or smtp_server
+        self.port = port or smtp_port
+        self.username = username or sender_email
+        self.password = password if password is not None else sender_password
+        self.smtp = None
+        self.lock = threading.Lock()
+
+    def connection(self):
+        # Reuse the open connection while the server still answers
+        if self.smtp is not None:
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.close()
+        smtp = smtplib.SMTP(self.host, self.port, timeout=smtp_timeout)
+        try:
+            smtp.ehlo()
+            if smtp.has_extn("starttls"):
+                smtp.starttls()
+                smtp.ehlo()
+            elif self.password and not smtp_allow_plaintext:
+                # Never send the password in cleartext, e.g. when STARTTLS was stripped from the reply
+                raise smtplib.SMTPNotSupportedError(
+                    f"{self.host} does not offer STARTTLS, refusing to log in without encryption"
+                )
+            if self.password:
+                smtp.login(self.username, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        return smtp
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.smtp.close()
+            self.smtp = None
+
+    def send_streamed(self, sender, recipients, chunks):
+        """
+        Send one message in a single SMTP transaction, writing the chunks to
+        the socket as they are produced instead of building the message first.
+        Returns:
+          A dict of the recipients the server refused.
+        """
+        smtp = self.connection()
+        code, response = smtp.mail(sender)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, response, sender)
+        refused = {}
+        for recipient in recipients:
+            code, response = smtp.rcpt(recipient)
+            if code not in (250, 251):
+                refused[recipient] = (code, response)
+        if len(refused) == len(recipients):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, response = smtp.docmd("data")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, response)
+        for chunk in chunks:
+            smtp.send(chunk)
+        smtp.send(b".\r\n")
+        code, response = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    def send(self, recipients, subject, html, attachment_path=None, content_type=None):
+        """
+        Send a message to all recipients in batches of `smtp_batch_size`,
+        retrying each batch with exponential backoff on transient failures.
+        Args:
+          recipients: List of email recipients.
+          subject: The subject line.
+          html: The HTML body.
+          attachment_path: Path of the file to attach, or None.
+          content_type: MIME type of the attachment.
+        Returns:
+          A dict of the recipients the server refused.
+        """
+        refused = {}
+        with self.lock:
+            for start in range(0, len(recipients), max(smtp_batch_size, 1)):
+                batch = recipients[start : start + max(smtp_batch_size, 1)]
+                for attempt in range(1, smtp_retries + 1):
+                    try:
+                        refused.update(
+                            self.send_streamed(
+                                self.username,
+                                batch,
+                                message_chunks(
+                                    self.username,
+                                    recipients,
+                                    subject,
+                                    html,
+                                    attachment_path,
+                                    content_type,
+                                ),
+                            )
+                        )
+                        break
+                    except Exception as e:
+                        # The connection may be mid-transaction, start over on a new one
+                        self.close()
+                        if not is_retryable(e) or attempt == smtp_retries:
+                            raise DeliveryError(f"Failed to send email: {e}") from e
+                        delay = smtp_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                        print_color(
+                            f"Sending email failed ({e}), retrying in {delay:.1f} seconds",
+                            RED,
+                        )
+                        time.sleep(delay)
+        return refused
+
+
+# Connection shared by every delivery of the process
+_mailer = None
+# Deliveries that have not finished yet
+_pending = set()
+_pending_lock = threading.Lock()
+# Deliveries waiting for the delivery thread
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+# Function to get the mailer shared by all deliveries
+def get_mailer():
+    global _mailer
+    if _mailer is None:
+        _mailer = Mailer()
+    return _mailer
+
+
+# Function to process queued deliveries one after another on one connection
+def _deliveries():
+    while True:
+        try:
+            future, job = _queue.get(timeout=smtp_timeout)
+        except queue.Empty:
+            # Close the connection when there is nothing left to send
+            if _mailer is not None:
+                with _mailer.lock:
+                    _mailer.close()
+            continue
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(job())
+            except BaseException as e:
+                future.set_exception(e)
+
+
+# Function to queue a report for delivery without waiting for it
+def deliver(recipients, subject, html, report_path):
+    """
+    Queue an email with the report for the background delivery thread.
+    Large reports are compressed or linked according to `email_attachment_limit`.
+    Args:
+      recipients: List of email recipients.
+      subject: The subject line.
+      html: The HTML body, a link to the report is added when it is not attached.
+      report_path: Path of the report file.
+    Returns:
+      A `Future` resolved with the dict of refused recipients once the email
+      has been sent, or with a `DeliveryError`.
+    """
+    global _worker
+
+    def job():
+        with perf_stage("smtp_send"):
+            attachment_path, content_type, link = prepare_attachment(report_path)
+            body = html
+            if link:
+                body = html.replace(
+                    "</body>",
+                    f'<p>The report is too large to attach, download it from <a href="{link}">{link}</a>.</p></body>',
+                )
+            return get_mailer().send(recipients, subject, body, attachment_path, content_type)
+
+    def done(future):
+        with _pending_lock:
+            _pending.discard(future)
+        if future.exception() is not None:
+            print_color(str(future.exception()), RED)
+        else:
+            print_color(f"Email sent to {', '.join(recipients)}", GREEN)
+
+    future = Future()
+    with _pending_lock:
+        _pending.add(future)
+    future.add_done_callback(done)
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_deliveries, name="email-delivery", daemon=True)
+            _worker.start()
+    _queue.put((future, job))
+    return future
+
+
+# Function to wait until queued emails have been sent
+def wait_for_deliveries(timeout=None):
+    """
+    Block until every queued email has been sent or has failed.
+    Args:
+      timeout: Seconds to wait at most, None to wait as long as it takes.
+    Returns:
+      True if every delivery succeeded.
+    """
+    with _pending_lock:
+        pending = list(_pending)
+    done, not_done = wait(pending, timeout=timeout)
+    if not_done:
+        print_color(f"{len(not_done)} email deliveries did not finish in time", RED)
+    return not not_done and all(future.exception() is None for future in done)
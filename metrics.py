@@ -0,0 +1,199 @@
+import os
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from healthcheck import print_color, request_budget_spent, NC
+
+# Port the /metrics and /healthz endpoints listen on
+metrics_port = int(os.environ.get("metrics_port", 8000))
+# Upper bounds, in seconds, of the check duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _sample(name, value, **labels):
+    if labels:
+        label_text = ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+        return f"{name}{{{label_text}}} {value}"
+    return f"{name} {value}"
+
+
+class Histogram:
+    """A minimal Prometheus histogram with one series per check name."""
+
+    def __init__(self, name, documentation, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # check name -> [bucket counts..., sum, count]
+        self.series = {}
+
+    def observe(self, check, value):
+        with self.lock:
+            series = self.series.setdefault(check, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            for check, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(_sample(f"{self.name}_bucket", count, check=check, le=bound))
+                lines.append(_sample(f"{self.name}_bucket", series[-1], check=check, le="+Inf"))
+                lines.append(_sample(f"{self.name}_sum", series[-2], check=check))
+                lines.append(_sample(f"{self.name}_count", series[-1], check=check))
+        return lines
+
+
+def _family(name, metric_type, documentation, samples):
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}", *samples]
+
+
+# Function to render the cached health state in the Prometheus text format
+def render_metrics(summary, nodes, pods, latest_backups, durations):
+    """
+    Render check results in the Prometheus text exposition format.
+    Args:
+      summary: A dict mapping each check name to "PASSED" or "FAILED".
+      nodes: A list of `NodeRecord` instances.
+      pods: An iterable of `PodRecord` instances.
+      latest_backups: The newest `BackupRecord` of each Velero schedule.
+      durations: A `Histogram` of check durations.
+    Returns:
+      The exposition text as bytes.
+    """
+    lines = _family(
+        "k8shealthcheck_check_passed",
+        "gauge",
+        "Whether the health check passed (1) or failed (0).",
+        [
+            _sample("k8shealthcheck_check_passed", int(status == "PASSED"), check=check)
+            for check, status in summary.items()
+        ],
+    )
+    lines += _family(
+        "k8shealthcheck_node_ready",
+        "gauge",
+        "Whether the node has a Ready condition set to True.",
+        [
+            _sample(
+                "k8shealthcheck_node_ready",
+                int(node.ready),
+                node=node.name,
+                version=node.kubelet_version,
+            )
+            for node in nodes
+        ],
+    )
+    phase_counts = {}
+    for pod in pods:
+        key = (pod.namespace, pod.phase)
+        phase_counts[key] = phase_counts.get(key, 0) + 1
+    lines += _family(
+        "k8shealthcheck_pods",
+        "gauge",
+        "Number of pods per namespace and phase.",
+        [
+            _sample("k8shealthcheck_pods", count, namespace=namespace, phase=phase)
+            for (namespace, phase), count in sorted(phase_counts.items())
+        ],
+    )
+    backup_samples = []
+    phase_samples = []
+    now = datetime.now(timezone.utc)
+    for backup in latest_backups:
+        created = datetime.fromisoformat(backup.creation_timestamp.replace("Z", "+00:00"))
+        labels = dict(schedule=backup.schedule, backup=backup.name)
+        backup_samples.append(
+            _sample(
+                "k8shealthcheck_velero_latest_backup_age_seconds",
+                round((now - created).total_seconds(), 3),
+                **labels,
+            )
+        )
+        phase_samples.append(
+            _sample(
+                "k8shealthcheck_velero_latest_backup_phase",
+                1,
+                phase=backup.phase,
+                **labels,
+            )
+        )
+    lines += _family(
+        "k8shealthcheck_velero_latest_backup_age_seconds",
+        "gauge",
+        "Age of the most recent Velero backup of each schedule.",
+        backup_samples,
+    )
+    lines += _family(
+        "k8shealthcheck_velero_latest_backup_phase",
+        "gauge",
+        "Phase of the most recent Velero backup of each schedule.",
+        phase_samples,
+    )
+    lines += durations.render()
+    return ("\n".join(lines) + "\n").encode()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve /metrics and /healthz from the daemon's cached state, never from the API."""
+
+    daemon = None
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.daemon.metrics_text
+            status = 200 if body else 503
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/healthz":
+            synced = all(informer.synced.is_set() for informer in self.daemon.informers)
+            if not synced:
+                status, body = 503, b"caches not synced\n"
+            elif request_budget_spent():
+                # Informers cannot re-list until the next report resets the budget
+                status, body = 503, b"API request budget spent\n"
+            else:
+                status, body = 200, b"ok\n"
+            content_type = "text/plain; charset=utf-8"
+        else:
+            status, body, content_type = 404, b"not found\n", "text/plain; charset=utf-8"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body or b"")))
+        self.end_headers()
+        self.wfile.write(body or b"")
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent, keep them out of the report logs
+        pass
+
+
+# Function to start the metrics server
+def start_metrics_server(daemon, port=metrics_port):
+    """
+    Serve /metrics and /healthz for a `HealthDaemon` on a background thread.
+    Args:
+      daemon: The `HealthDaemon` whose cached state is exposed.
+      port: The port to listen on.
+    Returns:
+      The running `ThreadingHTTPServer`.
+    """
+    handler = type("BoundMetricsHandler", (MetricsHandler,), {"daemon": daemon})
+    server = ThreadingHTTPServer(("", port), handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    ).start()
+    print_color(f"Serving /metrics and /healthz on port {port}", NC)
+    return server
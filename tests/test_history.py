@@ -0,0 +1,62 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import history  # noqa: E402
+
+
+def pod_results(workloads):
+    rows = [["Namespace", "Workload", "Ready", "Restarts", "Status"]]
+    rows += [["default", f"Deployment/app-{i}", "0/1", "3", "CrashLoopBackOff"] for i in range(workloads)]
+    return {"pods": ("FAILED", rows)}
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "history.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_new_database_uses_incremental_auto_vacuum(self):
+        store = history.HistoryStore(self.path)
+        try:
+            self.assertEqual(store.db.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        finally:
+            store.close()
+
+    def test_existing_database_is_converted_to_incremental_auto_vacuum(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.executescript(history.SCHEMA)
+        db.close()
+        store = history.HistoryStore(self.path)
+        try:
+            self.assertEqual(store.db.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        finally:
+            store.close()
+
+    def test_compact_shrinks_the_file(self):
+        store = history.HistoryStore(self.path)
+        try:
+            old = datetime.now() - timedelta(days=200)
+            for run in range(50):
+                store.record_run(f"cluster-{run}", old + timedelta(hours=run), pod_results(200))
+            store.record_run("cluster", datetime.now(), pod_results(1))
+            store.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            size = os.path.getsize(self.path)
+            self.assertEqual(store.compact(retention_days=90), 50)
+            self.assertLess(os.path.getsize(self.path), size / 2)
+            self.assertEqual(store.check_failure_rate()["pods"]["runs"], 1)
+        finally:
+            store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()